@@ -0,0 +1,143 @@
+"""
+Admission control for model calls
+Caps how many calls run at once, per user and in total. Calls over the
+global limit wait in a bounded FIFO queue with a deadline; when the queue is
+full, the deadline passes or a user already has too many calls, the request
+is turned away straight away instead of tying up a worker.
+
+Limits are per process, so with several workers multiply accordingly.
+"""
+import asyncio
+import os
+import threading
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+MAX_CONCURRENT = int(os.environ.get('LLM_MAX_CONCURRENT', '32'))
+MAX_QUEUED = int(os.environ.get('LLM_MAX_QUEUED', '64'))
+MAX_PER_USER = int(os.environ.get('LLM_MAX_PER_USER', '2'))
+QUEUE_TIMEOUT = float(os.environ.get('LLM_QUEUE_TIMEOUT', '10'))
+
+
+class AdmissionRejected(Exception):
+    """A call was turned away; status is the HTTP status to answer with"""
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, user_id, wake):
+        self.user_id = user_id
+        self.wake = wake
+        self.granted = False
+
+
+class Scheduler:
+    """Concurrency limiter shared by worker threads and the ASGI event loop"""
+
+    def __init__(self, max_concurrent, max_queued, max_per_user, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._per_user = {}  # user id -> calls running or queued
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def _admit(self, user_id, wake):
+        """Take a slot now (returns None) or join the queue (returns the waiter)"""
+        with self._lock:
+            if self._per_user.get(user_id, 0) >= self.max_per_user:
+                raise AdmissionRejected(429, 'Too many requests in progress. Please wait for your previous message.', 1)
+            if self._active < self.max_concurrent and not self._waiters:
+                self._active += 1
+                self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+                return None
+            if len(self._waiters) >= self.max_queued:
+                raise AdmissionRejected(503, 'The assistant is busy right now. Please try again shortly.', 5)
+            waiter = _Waiter(user_id, wake)
+            self._waiters.append(waiter)
+            self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+            return waiter
+
+    def _give_up(self, waiter):
+        """Leave the queue; returns False if a slot was granted meanwhile"""
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._waiters.remove(waiter)
+            self._forget(waiter.user_id)
+            return True
+
+    def _forget(self, user_id):
+        count = self._per_user.get(user_id, 0) - 1
+        if count > 0:
+            self._per_user[user_id] = count
+        else:
+            self._per_user.pop(user_id, None)
+
+    def release(self, user_id):
+        """Free a slot, handing it straight to the next queued call"""
+        with self._lock:
+            self._forget(user_id)
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+            else:
+                self._active -= 1
+                waiter = None
+        if waiter:
+            waiter.wake()
+
+    def acquire(self, user_id):
+        """Wait for a slot from a worker thread; raises AdmissionRejected"""
+        event = threading.Event()
+        waiter = self._admit(user_id, event.set)
+        if waiter and not event.wait(self.queue_timeout) and self._give_up(waiter):
+            raise AdmissionRejected(503, 'The assistant is busy right now. Please try again shortly.', 5)
+
+    async def acquire_async(self, user_id):
+        """Wait for a slot on the event loop; raises AdmissionRejected"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        waiter = self._admit(user_id, wake)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._give_up(waiter):
+                raise AdmissionRejected(503, 'The assistant is busy right now. Please try again shortly.', 5)
+        except BaseException:
+            # Cancelled while queued: leave the queue, or pass on a slot we just got
+            if not self._give_up(waiter):
+                self.release(user_id)
+            raise
+
+    @contextmanager
+    def slot(self, user_id):
+        self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+    @asynccontextmanager
+    async def async_slot(self, user_id):
+        await self.acquire_async(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+
+scheduler = Scheduler(MAX_CONCURRENT, MAX_QUEUED, MAX_PER_USER, QUEUE_TIMEOUT)
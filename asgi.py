@@ -0,0 +1,435 @@
+"""
+Health AI Assistant - ASGI entry point
+Chat replies are awaited on the event loop with the async OpenAI client, so
+one process can hold many conversations open without a worker per request.
+Every other route (uploads, history, pages) runs the Flask app in a thread.
+
+Run with: uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import jsonify
+from flask_login import current_user
+from werkzeug.datastructures import Headers
+from werkzeug.test import EnvironBuilder
+import admission
+import idempotency
+import llm
+import resilience
+import web_app
+
+flask_app = web_app.app
+
+# Threads for blocking work: Flask routes, SQLite and session storage
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', '64'))
+_executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi-sync')
+
+
+async def run_sync(func, *args):
+    """Run blocking code off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+
+
+class RequestTooLarge(Exception):
+    """The request body is over web_app.MAX_REQUEST_SIZE"""
+
+
+async def read_body(receive, scope):
+    """Read the full request body, raising RequestTooLarge once it passes
+    MAX_REQUEST_SIZE rather than buffering it all"""
+    for name, value in scope['headers']:
+        if name == b'content-length' and value.isdigit() and int(value) > web_app.MAX_REQUEST_SIZE:
+            raise RequestTooLarge()
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > web_app.MAX_REQUEST_SIZE:
+            raise RequestTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the reply was ready"""
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def unless_disconnected(receive, coro):
+    """Await coro, cancelling it (and the upstream call inside) if the client disconnects"""
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        watcher.cancel()
+        raise
+
+    watcher.cancel()
+    if task in done:
+        return task.result()
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    raise ClientDisconnected()
+
+
+def build_environ(scope, body):
+    """Build a WSGI environ for the Flask app from an ASGI scope"""
+    headers = Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']])
+    client = scope.get('client') or ('127.0.0.1', 0)
+
+    builder = EnvironBuilder(
+        path=scope['path'],
+        base_url=f"{scope.get('scheme', 'http')}://{headers.get('Host', 'localhost')}",
+        query_string=scope.get('query_string', b'').decode('latin-1'),
+        method=scope['method'],
+        headers=headers,
+        data=body,
+        # flask-login's strong session protection hashes the client address
+        environ_overrides={'REMOTE_ADDR': client[0]}
+    )
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def freeze_response(response):
+    """Turn a Flask response into (status, headers, body)"""
+    return response.status_code, response.headers.to_wsgi_list(), response.get_data()
+
+
+async def send_response(send, status, headers, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, payload, status=200):
+    await send_response(send, status, [('Content-Type', 'application/json')], json.dumps(payload).encode())
+
+
+async def send_rejected(send, rejection):
+    """Fast 429/503 for a chat request turned away by admission control"""
+    await send_response(send, rejection.status, [
+        ('Content-Type', 'application/json'),
+        ('Retry-After', str(rejection.retry_after))
+    ], json.dumps({'success': False, 'error': rejection.message}).encode())
+
+
+def prepare_chat(environ):
+    """Authenticate and build the model input inside a Flask request context
+
+    Returns (chat, None), or (None, frozen response) if the request is rejected.
+    """
+    with flask_app.request_context(environ):
+        if not current_user.is_authenticated:
+            return None, freeze_response(web_app.login_manager.unauthorized())
+
+        user_message, error = web_app.parse_chat_request()
+        if error:
+            return None, freeze_response(error)
+
+        try:
+            full_message, context_tokens = web_app.build_chat_input(user_message)
+            tier = web_app.route_chat(user_message, context_tokens)
+        except Exception as e:
+            return None, freeze_response(jsonify({'success': False, 'error': f'Error: {str(e)}'}))
+
+        return {
+            'api_key': current_user.api_key,
+            'user_id': current_user.id,
+            'idempotency_key': web_app.get_idempotency_key(),
+            'user_message': user_message,
+            'full_message': full_message,
+            'context_tokens': context_tokens,
+            'tier': tier,
+            'cache_key': web_app.chat_cache_key(full_message, tier)
+        }, None
+
+
+async def record_interrupted(environ, prepared, partial):
+    """Keep a turn cut off by a client disconnect in the history"""
+    await run_sync(finish_chat, environ, prepared['user_message'], web_app.interrupted_reply(partial))
+    await abandon_idempotent(prepared)
+
+
+async def acquire_idempotency_key(prepared):
+    """Async idempotency.acquire(): claim the request's key or wait for its owner"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + idempotency.IDEMPOTENCY_WAIT
+    interval = idempotency.POLL_INTERVAL
+    args = (prepared['user_id'], prepared['idempotency_key'], prepared['user_message'])
+    state, result = await run_sync(idempotency.check, *args)
+    while state == 'pending':
+        if loop.time() >= deadline:
+            return 'timeout', None
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, idempotency.MAX_POLL_INTERVAL)
+        state, result = await run_sync(idempotency.poll, *args)
+    return state, result
+
+
+async def finish_idempotent(prepared, result):
+    if prepared['idempotency_key']:
+        await run_sync(idempotency.finish, prepared['user_id'], prepared['idempotency_key'], result)
+
+
+async def abandon_idempotent(prepared):
+    if prepared['idempotency_key']:
+        await run_sync(idempotency.abandon, prepared['user_id'], prepared['idempotency_key'])
+
+
+def finish_chat(environ, user_message, ai_message):
+    """Record a finished turn in the session and database"""
+    with flask_app.request_context(environ):
+        web_app.record_chat_turn(user_message, ai_message)
+        web_app.save_session_now()
+
+
+async def chat(scope, receive, send):
+    """Async version of /api/chat"""
+    environ = build_environ(scope, await read_body(receive, scope))
+    prepared, error = await run_sync(prepare_chat, environ)
+    if error:
+        return await send_response(send, *error)
+
+    if prepared['idempotency_key']:
+        state, stored = await acquire_idempotency_key(prepared)
+        if state != 'owner':
+            return await send_json(send, *idempotency.replay(state, stored))
+
+    try:
+        ai_message = llm.response_cache.get(prepared['cache_key'])
+        usage = None
+        if ai_message is None:
+            client = llm.get_async_client(prepared['api_key'])
+            async with admission.scheduler.async_slot(prepared['user_id']):
+                started = time.monotonic()
+                response = await unless_disconnected(receive, resilience.acall(
+                    lambda: client.responses.create(
+                        **prepared['tier'].request_args(),
+                        input=prepared['full_message']
+                    )
+                ))
+                web_app.router.record(prepared['tier'], started)
+            ai_message = llm.extract_response_text(response)
+            usage = llm.extract_usage(response)
+            if ai_message is None:
+                ai_message = web_app.FALLBACK_REPLY
+            else:
+                llm.response_cache.put(prepared['cache_key'], ai_message)
+        await run_sync(finish_chat, environ, prepared['user_message'], ai_message)
+    except ClientDisconnected:
+        return await record_interrupted(environ, prepared, "")
+    except admission.AdmissionRejected as e:
+        await abandon_idempotent(prepared)
+        return await send_rejected(send, e)
+    except Exception as e:
+        await abandon_idempotent(prepared)
+        return await send_json(send, {'success': False, 'error': f'Error: {str(e)}'})
+
+    result = {'success': True, 'message': ai_message}
+    if web_app.REPORT_TOKEN_USAGE:
+        result['usage'] = usage
+        result['context_tokens'] = prepared['context_tokens']
+        result['tier'] = prepared['tier'].name
+    await finish_idempotent(prepared, result)
+    await send_json(send, result)
+
+
+async def start_event_stream(send):
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')
+        ]
+    })
+
+
+async def send_event(send, payload, more_body=True):
+    await send({
+        'type': 'http.response.body',
+        'body': web_app.sse_event(payload).encode(),
+        'more_body': more_body
+    })
+
+
+async def chat_stream(scope, receive, send):
+    """Async version of /api/chat/stream"""
+    environ = build_environ(scope, await read_body(receive, scope))
+    prepared, error = await run_sync(prepare_chat, environ)
+    if error:
+        return await send_response(send, *error)
+
+    ai_message = None
+    if prepared['idempotency_key']:
+        state, stored = await acquire_idempotency_key(prepared)
+        if state == 'done':
+            ai_message = stored['message']
+        elif state != 'owner':
+            return await send_json(send, *idempotency.replay(state, stored))
+
+    if ai_message is None:
+        ai_message = llm.response_cache.get(prepared['cache_key'])
+        if ai_message is None:
+            # Take a model call slot before any headers go out, so a busy server can still say 429/503
+            try:
+                resilience.breaker.check()
+                await admission.scheduler.acquire_async(prepared['user_id'])
+            except admission.AdmissionRejected as e:
+                await abandon_idempotent(prepared)
+                return await send_rejected(send, e)
+            try:
+                return await stream_reply(environ, prepared, receive, send)
+            finally:
+                admission.scheduler.release(prepared['user_id'])
+
+        await run_sync(finish_chat, environ, prepared['user_message'], ai_message)
+        await finish_idempotent(prepared, {'success': True, 'message': ai_message})
+
+    await start_event_stream(send)
+    await send_event(send, {'type': 'delta', 'text': ai_message})
+    await send_event(send, {'type': 'done', 'message': ai_message}, more_body=False)
+
+
+async def stream_reply(environ, prepared, receive, send):
+    """Stream a reply from the model as Server-Sent Events"""
+    await start_event_stream(send)
+
+    parts = []
+    usage = None
+
+    async def relay():
+        nonlocal usage
+        client = llm.get_async_client(prepared['api_key'])
+        # Hedging races copies of the request on their first event
+        opened = await resilience.acall(
+            lambda: llm.open_async_stream(client.responses.create(
+                **prepared['tier'].request_args(),
+                input=prepared['full_message'],
+                stream=True
+            )),
+            discard=llm.close_stream
+        )
+        try:
+            async for event in opened[1]:
+                if event.type == 'response.output_text.delta':
+                    parts.append(event.delta)
+                    await send_event(send, {'type': 'delta', 'text': event.delta})
+                elif event.type == 'response.completed':
+                    usage = llm.extract_usage(event.response)
+        finally:
+            # Closing the stream drops the upstream connection, which stops generation
+            closing = llm.close_stream(opened)
+            if closing is not None:
+                await closing
+
+    try:
+        started = time.monotonic()
+        await unless_disconnected(receive, relay())
+        web_app.router.record(prepared['tier'], started)
+        ai_message = "".join(parts)
+        if ai_message:
+            llm.response_cache.put(prepared['cache_key'], ai_message)
+        else:
+            ai_message = web_app.FALLBACK_REPLY
+        await run_sync(finish_chat, environ, prepared['user_message'], ai_message)
+    except ClientDisconnected:
+        return await record_interrupted(environ, prepared, "".join(parts))
+    except Exception as e:
+        await abandon_idempotent(prepared)
+        return await send_event(send, {'type': 'error', 'error': f'Error: {str(e)}'}, more_body=False)
+
+    done = {'type': 'done', 'message': ai_message}
+    if web_app.REPORT_TOKEN_USAGE:
+        done['usage'] = usage
+        done['context_tokens'] = prepared['context_tokens']
+        done['tier'] = prepared['tier'].name
+    await finish_idempotent(prepared, {'success': True, 'message': ai_message})
+    await send_event(send, done, more_body=False)
+
+
+def run_wsgi(environ):
+    """Call the Flask app and collect its whole response"""
+    captured = []
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+        return written.append
+
+    result = flask_app(environ, start_response)
+    try:
+        body = b''.join(written) + b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    status, headers = captured
+    return int(status.split(' ', 1)[0]), headers, body
+
+
+async def flask_fallback(scope, receive, send):
+    """Serve any other route with the Flask app in a worker thread"""
+    environ = build_environ(scope, await read_body(receive, scope))
+    await send_response(send, *await run_sync(run_wsgi, environ))
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Wait for threaded Flask calls to finish without blocking the loop,
+            # which may still be serving the requests that are waiting on them
+            await asyncio.get_running_loop().run_in_executor(None, lambda: _executor.shutdown(wait=True))
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+ASYNC_ROUTES = {
+    ('POST', '/api/chat'): chat,
+    ('POST', '/api/chat/stream'): chat_stream,
+}
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    handler = ASYNC_ROUTES.get((scope['method'], scope['path']), flask_fallback)
+    try:
+        await handler(scope, receive, send)
+    except RequestTooLarge:
+        # Raised while reading the body, before any response was started
+        await send_json(send, {'success': False, 'error': 'File too large (max 10MB)'}, 413)
@@ -0,0 +1,199 @@
+"""
+Write-behind persistence for chat turns
+Requests queue their new messages in memory and return; a background thread
+writes the queue out in batches, one transaction each, once CHAT_FLUSH_BATCH
+turns are waiting or CHAT_FLUSH_INTERVAL seconds have passed. The queue is
+drained at interpreter exit (including SIGINT and gunicorn's graceful worker
+shutdown), so only a hard kill can lose the turns of the last interval.
+
+Turns that fail to write because the database is busy or locked stay at the
+head of the queue and are retried with backoff until shutdown, which retries
+them for up to CHAT_FLUSH_TIMEOUT seconds more before giving up. Any other
+error would fail again on retry, so those turns are logged and dropped.
+
+Readers that must see a user's latest turns in the database call
+flush(user_id) first. CHAT_WRITE_BEHIND=0 writes each turn synchronously instead.
+"""
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+import database as db
+
+WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '1') == '1'
+FLUSH_INTERVAL = float(os.environ.get('CHAT_FLUSH_INTERVAL', '0.2'))
+FLUSH_BATCH = int(os.environ.get('CHAT_FLUSH_BATCH', '100'))
+RETRY_DELAY = 1.0  # first wait before retrying failed turns; doubles up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 30.0
+FLUSH_TIMEOUT = float(os.environ.get('CHAT_FLUSH_TIMEOUT', '10'))
+
+logger = logging.getLogger(__name__)
+
+
+class ChatWriter:
+    """Queues chat appends and writes them in batches from a background thread"""
+
+    def __init__(self, enabled, flush_interval, flush_batch):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._queue = []  # (user_id, chat_id, title, messages), in arrival order
+        self._pending = {}  # user id -> turns queued and not yet written or dropped
+        self._retrying = 0  # failed turns waiting at the head of the queue
+        self._retry_at = 0.0  # monotonic time before which they aren't retried
+        self._retry_delay = RETRY_DELAY
+        self._flush_requested = False
+        self._stopping = False
+        self._thread = None
+        self._pid = None
+        self._cond = threading.Condition()
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def append(self, user_id, chat_id, title, messages):
+        """Queue messages to append to a chat (see db.append_chat_messages)"""
+        if self.enabled:
+            with self._cond:
+                if not self._stopping:
+                    self._ensure_thread()
+                    self._queue.append((user_id, chat_id, title, messages))
+                    self._pending[user_id] = self._pending.get(user_id, 0) + 1
+                    if len(self._queue) >= self.flush_batch:
+                        self._cond.notify_all()
+                    return
+        db.append_chat_messages(user_id, chat_id, title, messages)
+
+    def flush(self, user_id, timeout=FLUSH_TIMEOUT):
+        """Wait until the turns queued for a user are in the database"""
+        with self._cond:
+            if not self._pending.get(user_id):
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._pending.get(user_id), timeout)
+
+    def close(self):
+        """Stop the background thread and write out whatever is still queued,
+        retrying failed turns for up to FLUSH_TIMEOUT seconds"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread:
+            thread.join(FLUSH_TIMEOUT)
+        deadline = time.monotonic() + FLUSH_TIMEOUT
+        while True:
+            with self._cond:
+                batch, self._queue = self._queue, []
+            if not batch or not self._write(batch):
+                return
+            delay = self._retry_at - time.monotonic()
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(max(delay, 0))
+        with self._cond:
+            lost, self._queue = self._queue, []
+            self._settle(lost)
+            self.dropped += len(lost)
+            self._retrying = 0
+        logger.error("Gave up on %d chat turns still failing to write at shutdown (chats: %s)",
+                     len(lost), ', '.join(sorted({str(entry[1]) for entry in lost})))
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each worker process starts its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # A batch is due after the interval, or sooner when it fills up
+                # or a flush is requested, but never before failed turns may be retried
+                deadline = max(time.monotonic() + self.flush_interval, self._retry_at)
+                while not self._stopping:
+                    now = time.monotonic()
+                    if now >= self._retry_at and (self._flush_requested or len(self._queue) >= self.flush_batch):
+                        break
+                    if now >= deadline:
+                        break
+                    self._cond.wait((self._retry_at if now < self._retry_at else deadline) - now)
+                if self._stopping:
+                    return
+                self._flush_requested = False
+                batch, self._queue = self._queue, []
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        """Write a batch in one transaction, returning the entries that failed
+
+        If the transaction fails the entries are written one at a time, so a bad
+        one can't hold up the rest. Entries that failed because the database
+        was busy, and the later ones for the same chats so their turns stay in
+        order, go back to the head of the queue to be retried after a backoff.
+        Entries that failed any other way are dropped.
+        """
+        failed = []
+        dropped = 0
+        try:
+            db.append_chat_messages_batch(batch)
+        except Exception:
+            logger.warning("Error writing %d chat turns, retrying one by one", len(batch), exc_info=True)
+            held = set()
+            for entry in batch:
+                if entry[1] not in held:
+                    try:
+                        db.append_chat_messages(*entry)
+                        continue
+                    except sqlite3.OperationalError:
+                        logger.warning("Error writing turn to chat %s, will retry", entry[1], exc_info=True)
+                        held.add(entry[1])
+                    except Exception:
+                        logger.error("Error writing turn to chat %s, dropped", entry[1], exc_info=True)
+                        dropped += 1
+                        continue
+                failed.append(entry)
+        with self._cond:
+            self.batches += 1
+            self.dropped += dropped
+            retried = {id(entry) for entry in failed}
+            self._settle(entry for entry in batch if id(entry) not in retried)
+            self._retrying = len(failed)
+            if failed:
+                self.failures += len(failed)
+                self._queue[:0] = failed
+                self._retry_at = time.monotonic() + self._retry_delay
+                self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY)
+            else:
+                self._retry_at = 0.0
+                self._retry_delay = RETRY_DELAY
+            self._cond.notify_all()
+        return failed
+
+    def _settle(self, entries):
+        # Called with the lock held, for entries that were written or dropped
+        for entry in entries:
+            user_id = entry[0]
+            self._pending[user_id] -= 1
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+
+    def stats(self):
+        with self._cond:
+            return {
+                'enabled': self.enabled,
+                'queued': len(self._queue),
+                'retrying': self._retrying,
+                'batches': self.batches,
+                'failures': self.failures,
+                'dropped': self.dropped
+            }
+
+
+writer = ChatWriter(WRITE_BEHIND, FLUSH_INTERVAL, FLUSH_BATCH)
+atexit.register(writer.close)
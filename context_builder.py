@@ -0,0 +1,158 @@
+"""
+Token counting and token-budgeted prompt assembly
+"""
+import os
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Total input tokens we are willing to send per message
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '6000'))
+TOKENIZER_ENCODING = os.environ.get('TOKENIZER_ENCODING', 'o200k_base')
+CHARS_PER_TOKEN = 4  # estimate used when no tokenizer is available
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """Load the tokenizer once; None if tiktoken or its encoding is unavailable"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING) if tiktoken else None
+                except Exception:
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def tokenizer_name():
+    return TOKENIZER_ENCODING if _get_encoding() else 'estimate'
+
+
+def count_tokens(text):
+    """Count tokens in text"""
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to at most max_tokens tokens"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * CHARS_PER_TOKEN]
+
+
+def assemble_context(question, profile, documents, history,
+                     documents_header="", history_header="", summary="", budget=None):
+    """Fill a token budget by priority: question > profile > documents > summary > history
+
+    profile is the stable prefix text, documents are text blocks ordered most
+    relevant first, summary is the running summary of older turns and history
+    is formatted turns ordered oldest first. The result keeps the stable-first
+    layout: profile, documents, summary, history, question.
+    Returns (text, breakdown) where breakdown counts tokens per part.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    remaining = budget
+
+    question_tokens = count_tokens(question)
+    remaining -= question_tokens
+
+    profile_tokens = count_tokens(profile)
+    if profile_tokens > remaining:
+        profile = truncate_to_tokens(profile, remaining)
+        profile_tokens = count_tokens(profile)
+    remaining -= profile_tokens
+
+    # Whole documents while they fit; the first one that doesn't is cut to fit
+    included_documents = []
+    documents_tokens = 0
+    dropped_documents = 0
+    if documents:
+        header_tokens = count_tokens(documents_header)
+        if remaining > header_tokens:
+            remaining -= header_tokens
+            documents_tokens += header_tokens
+            for i, document in enumerate(documents):
+                tokens = count_tokens(document)
+                if tokens > remaining:
+                    document = truncate_to_tokens(document, remaining)
+                    tokens = count_tokens(document)
+                    dropped_documents = len(documents) - i - (1 if document else 0)
+                    if document:
+                        included_documents.append(document)
+                        documents_tokens += tokens
+                        remaining -= tokens
+                    break
+                included_documents.append(document)
+                documents_tokens += tokens
+                remaining -= tokens
+            if not included_documents:
+                remaining += header_tokens
+                documents_tokens = 0
+        else:
+            dropped_documents = len(documents)
+
+    summary_tokens = count_tokens(summary)
+    if summary_tokens > remaining:
+        summary = truncate_to_tokens(summary, remaining)
+        summary_tokens = count_tokens(summary)
+    remaining -= summary_tokens
+
+    # Newest turns first, whole turns only
+    included_history = []
+    history_tokens = 0
+    if history:
+        header_tokens = count_tokens(history_header)
+        if remaining > header_tokens:
+            remaining -= header_tokens
+            history_tokens += header_tokens
+            for turn in reversed(history):
+                tokens = count_tokens(turn)
+                if tokens > remaining:
+                    break
+                included_history.append(turn)
+                history_tokens += tokens
+                remaining -= tokens
+            included_history.reverse()
+            if not included_history:
+                remaining += header_tokens
+                history_tokens = 0
+
+    parts = [profile]
+    if included_documents:
+        parts.append(documents_header)
+        parts.extend(included_documents)
+    parts.append(summary)
+    if included_history:
+        parts.append(history_header)
+        parts.extend(included_history)
+    parts.append(question)
+
+    breakdown = {
+        'tokenizer': tokenizer_name(),
+        'budget': budget,
+        'question': question_tokens,
+        'profile': profile_tokens,
+        'documents': documents_tokens,
+        'summary': summary_tokens,
+        'history': history_tokens,
+        'total': question_tokens + profile_tokens + documents_tokens + summary_tokens + history_tokens,
+        'documents_dropped': dropped_documents,
+        'history_dropped': len(history) - len(included_history)
+    }
+    return "".join(parts), breakdown
@@ -3,6 +3,11 @@ Database models and functions for user accounts
 """
 import sqlite3
 import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
@@ -11,58 +16,336 @@ BASE_DIR = Path(__file__).parent
 USER_DATA_DIR = BASE_DIR / "user_data_web"
 DB_PATH = USER_DATA_DIR / "users.db"
 
+# Connection tuning: WAL lets reads proceed while a write is in progress
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+# Workers starting together wait for each other's migrations, which can be slow
+INIT_BUSY_TIMEOUT_MS = int(os.environ.get('DB_INIT_BUSY_TIMEOUT_MS', '300000'))
+
+# Search snippets: words of context around a match
+SNIPPET_TOKENS = 16
+
+# One open connection per thread (and per process, after a fork)
+_local = threading.local()
+
+
+def get_connection():
+    """Get this thread's database connection, opening and tuning it on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        USER_DATA_DIR.mkdir(exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000)
+        _enable_wal(conn)
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+        _local.conn = conn
+        _local.pid = os.getpid()
+    elif conn.in_transaction:
+        # A previous caller failed mid-transaction; don't build on its writes
+        conn.rollback()
+    return conn
+
+
+def _enable_wal(conn):
+    # The switch needs the database to itself, and when other processes are
+    # opening it at the same time it can fail busy without waiting, so retry
+    deadline = time.monotonic() + BUSY_TIMEOUT_MS / 1000
+    while True:
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            return
+        except sqlite3.OperationalError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def release_connection(conn):
+    """Hand a connection back for reuse, ending any transaction left open"""
+    if conn.in_transaction:
+        conn.rollback()
+
+
+@contextmanager
+def connection():
+    """This thread's connection for a with block, released when it exits
+
+    A transaction the block leaves open, because it raised before committing,
+    is rolled back so the connection doesn't keep holding the write lock.
+    """
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+
 def init_db():
     """Initialize the database"""
     # Ensure directory exists
     USER_DATA_DIR.mkdir(exist_ok=True)
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Users table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            api_key TEXT,
-            profile TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Chats table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS chats (
-            id TEXT PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            title TEXT,
-            messages TEXT,
-            created_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-
-def create_user(email, password):
-    """Create a new user"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
+    with connection() as conn:
         c = conn.cursor()
         
-        password_hash = generate_password_hash(password)
+        # Every worker runs this at startup. Taking the write lock first makes
+        # them run the schema checks and migrations below one at a time, so
+        # none of them repeats a migration another has just made.
+        c.execute(f'PRAGMA busy_timeout = {INIT_BUSY_TIMEOUT_MS}')
+        c.execute('BEGIN IMMEDIATE')
         
-        c.execute(
-            'INSERT INTO users (email, password_hash) VALUES (?, ?)',
-            (email, password_hash)
-        )
+        # Users table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL,
+                api_key TEXT,
+                profile TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Bumped on every profile change so cached prompt context can be invalidated
+        c.execute('PRAGMA table_info(users)')
+        if 'profile_version' not in [row[1] for row in c.fetchall()]:
+            c.execute('ALTER TABLE users ADD COLUMN profile_version INTEGER DEFAULT 0')
+        
+        # Chats table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS chats (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                title TEXT,
+                messages TEXT,
+                created_at TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        
+        # Rolling summary of older turns, covering messages with seq < summarized_upto
+        c.execute('PRAGMA table_info(chats)')
+        chat_columns = [row[1] for row in c.fetchall()]
+        if 'summary' not in chat_columns:
+            c.execute('ALTER TABLE chats ADD COLUMN summary TEXT')
+        if 'summarized_upto' not in chat_columns:
+            c.execute('ALTER TABLE chats ADD COLUMN summarized_upto INTEGER DEFAULT 0')
+        if 'trimmed_count' not in chat_columns:
+            c.execute('ALTER TABLE chats ADD COLUMN trimmed_count INTEGER DEFAULT 0')
+        if 'message_count' not in chat_columns:
+            c.execute('ALTER TABLE chats ADD COLUMN message_count INTEGER DEFAULT 0')
+        
+        # Newest-first chat listing per user
+        c.execute('CREATE INDEX IF NOT EXISTS idx_chats_user_created ON chats (user_id, created_at, id)')
+        
+        # Messages used to be keyed on (chat_id, seq) alone, leaving the full-text
+        # index tied to implicit rowids that VACUUM may renumber; give them an
+        # explicit id, keeping the current rowids, and rebuild the index on it
+        c.execute('PRAGMA table_info(messages)')
+        message_columns = [row[1] for row in c.fetchall()]
+        if message_columns and 'id' not in message_columns:
+            c.execute('DROP TABLE IF EXISTS messages_fts')
+            c.execute('ALTER TABLE messages RENAME TO messages_old')
+        
+        # Chat messages, appended one row per message; seq counts from the start of the chat
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                chat_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TEXT,
+                UNIQUE (chat_id, seq),
+                FOREIGN KEY (chat_id) REFERENCES chats (id)
+            )
+        ''')
+        if message_columns and 'id' not in message_columns:
+            c.execute('''
+                INSERT INTO messages (id, chat_id, seq, role, content, created_at)
+                SELECT rowid, chat_id, seq, role, content, created_at FROM messages_old
+            ''')
+            c.execute('DROP TABLE messages_old')
+        
+        # Chats used to be saved as one JSON blob, trimmed to the newest messages;
+        # move them into rows, keeping their positions (the summary refers to them).
+        # The old column stays, emptied to '[]'.
+        c.execute("SELECT id, messages, trimmed_count, created_at FROM chats WHERE messages != '[]'")
+        for chat_id, messages_json, trimmed_count, created_at in c.fetchall():
+            messages = json.loads(messages_json)
+            start = trimmed_count or 0
+            c.executemany(
+                'INSERT OR IGNORE INTO messages (chat_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)',
+                [(chat_id, start + i, msg['role'], msg['content'], created_at) for i, msg in enumerate(messages)]
+            )
+            c.execute(
+                "UPDATE chats SET messages = '[]', message_count = ? WHERE id = ?",
+                (start + len(messages), chat_id)
+            )
+        
+        # Extracted PDF text, keyed by SHA-256 of the file contents
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_texts (
+                content_hash TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                created_at TEXT
+            )
+        ''')
+        
+        # Background PDF ingestion jobs
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_jobs (
+                id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                filename TEXT,
+                status TEXT,
+                pages_done INTEGER DEFAULT 0,
+                pages_total INTEGER,
+                preview TEXT,
+                error TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        c.execute('PRAGMA table_info(pdf_jobs)')
+        if 'content_hash' not in [row[1] for row in c.fetchall()]:
+            c.execute('ALTER TABLE pdf_jobs ADD COLUMN content_hash TEXT')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_jobs_hash ON pdf_jobs (content_hash, status)')
+        
+        # PDFs whose text could not be extracted, so they are not retried on every chat turn
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_failures (
+                content_hash TEXT PRIMARY KEY,
+                error TEXT,
+                failed_at TEXT
+            )
+        ''')
+        
+        # Uploaded PDFs are stored once per unique content; each user holds references
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS user_pdfs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                size INTEGER,
+                uploaded_at TEXT,
+                UNIQUE (user_id, filename),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_user_pdfs_hash ON user_pdfs (content_hash)')
+        
+        # The passage index used to be per user; it is rebuilt per document on demand
+        c.execute('PRAGMA table_info(pdf_chunks)')
+        if 'user_id' in [row[1] for row in c.fetchall()]:
+            c.execute('DROP TABLE IF EXISTS pdf_chunks')
+        
+        # Passage index over each unique PDF for relevance-ranked retrieval
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_chunks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                content_hash TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                length INTEGER NOT NULL
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_chunks_hash ON pdf_chunks (content_hash, seq)')
+        
+        # Term postings for ranking passages, keyed by document so a query only
+        # reads those of the asking user's PDFs. (pdf_chunks_fts serves search,
+        # but can only filter by user after matching everyone's passages.)
+        # The term index used to be global, or missing; passages indexed
+        # without it are dropped, to be re-indexed from the cached text.
+        c.execute('PRAGMA table_info(pdf_terms)')
+        if 'content_hash' not in [row[1] for row in c.fetchall()]:
+            c.execute('DROP TABLE IF EXISTS pdf_terms')
+            c.execute('DROP TABLE IF EXISTS pdf_chunks_fts')
+            c.execute('DROP TABLE IF EXISTS pdf_index')
+            c.execute('DELETE FROM pdf_chunks')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_terms (
+                content_hash TEXT NOT NULL,
+                term TEXT NOT NULL,
+                chunk_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                FOREIGN KEY (chunk_id) REFERENCES pdf_chunks (id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_pdf_terms_hash_term ON pdf_terms (content_hash, term)')
+        
+        # PDFs that have been indexed, including those without any passages
+        # (a scanned report has no text layer), so they aren't indexed again.
+        # When first created it is filled from the passages already indexed.
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'pdf_index'")
+        pdf_index_exists = c.fetchone() is not None
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_index (
+                content_hash TEXT PRIMARY KEY,
+                chunk_count INTEGER NOT NULL,
+                indexed_at TEXT
+            )
+        ''')
+        if not pdf_index_exists:
+            c.execute('''
+                INSERT INTO pdf_index (content_hash, chunk_count, indexed_at)
+                SELECT content_hash, COUNT(*), ? FROM pdf_chunks GROUP BY content_hash
+            ''', (datetime.now().isoformat(),))
+        
+        # Chat requests by client idempotency key, so retried sends reuse one reply
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS chat_requests (
+                user_id INTEGER NOT NULL,
+                idempotency_key TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                created_at TEXT,
+                PRIMARY KEY (user_id, idempotency_key),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_chat_requests_created ON chat_requests (created_at)')
+        
+        # Full-text search over chat messages and PDF passages. The FTS tables
+        # index the rows of messages and pdf_chunks and are updated along with them;
+        # when first created they are filled from what is already there.
+        c.execute("SELECT name FROM sqlite_master WHERE name IN ('messages_fts', 'pdf_chunks_fts')")
+        existing_fts = {row[0] for row in c.fetchall()}
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(content, content='messages', content_rowid='id')
+        ''')
+        c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS pdf_chunks_fts
+            USING fts5(text, content='pdf_chunks', content_rowid='id')
+        ''')
+        for table in ('messages_fts', 'pdf_chunks_fts'):
+            if table not in existing_fts:
+                c.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
         
         conn.commit()
-        user_id = c.lastrowid
-        conn.close()
+        c.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+
+
+def create_user(email, password):
+    """Create a new user"""
+    try:
+        with connection() as conn:
+            c = conn.cursor()
+            
+            password_hash = generate_password_hash(password)
+            
+            c.execute(
+                'INSERT INTO users (email, password_hash) VALUES (?, ?)',
+                (email, password_hash)
+            )
+            
+            conn.commit()
+            user_id = c.lastrowid
         
         return user_id
     except sqlite3.IntegrityError:
@@ -71,12 +354,11 @@ def create_user(email, password):
 
 def verify_user(email, password):
     """Verify user credentials"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('SELECT id, password_hash FROM users WHERE email = ?', (email,))
-    result = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('SELECT id, password_hash FROM users WHERE email = ?', (email,))
+        result = c.fetchone()
     
     if result and check_password_hash(result[1], password):
         return result[0]  # Return user_id
@@ -85,77 +367,156 @@ def verify_user(email, password):
 
 def get_user(user_id):
     """Get user data"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('SELECT id, email, api_key, profile FROM users WHERE id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('SELECT id, email, api_key, profile, profile_version FROM users WHERE id = ?', (user_id,))
+        result = c.fetchone()
     
     if result:
         return {
             'id': result[0],
             'email': result[1],
             'api_key': result[2],
-            'profile': json.loads(result[3]) if result[3] else None
+            'profile': json.loads(result[3]) if result[3] else None,
+            'profile_version': result[4] or 0
         }
     return None
 
 
+def get_recent_api_keys(limit):
+    """Get API keys of the users who chatted most recently"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT u.api_key
+            FROM users u
+            JOIN chats ch ON ch.user_id = u.id
+            WHERE u.api_key IS NOT NULL
+            GROUP BY u.id
+            ORDER BY MAX(ch.created_at) DESC
+            LIMIT ?
+        ''', (limit,))
+        
+        results = c.fetchall()
+    
+    return [row[0] for row in results]
+
+
 def update_api_key(user_id, api_key):
     """Update user's API key"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('UPDATE users SET api_key = ? WHERE id = ?', (api_key, user_id))
-    
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('UPDATE users SET api_key = ? WHERE id = ?', (api_key, user_id))
+        
+        conn.commit()
 
 
 def update_profile(user_id, profile):
     """Update user's health profile"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    profile_json = json.dumps(profile)
-    c.execute('UPDATE users SET profile = ? WHERE id = ?', (profile_json, user_id))
-    
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        c = conn.cursor()
+        
+        profile_json = json.dumps(profile)
+        c.execute(
+            'UPDATE users SET profile = ?, profile_version = profile_version + 1 WHERE id = ?',
+            (profile_json, user_id)
+        )
+        
+        conn.commit()
+
+
+def append_chat_messages(user_id, chat_id, title, messages):
+    """Append messages to a user's chat, creating the chat (with title) if needed
+
+    Only the new messages are written, so a turn costs the same however long
+    the chat is. Returns False if the chat id belongs to another user.
+    """
+    return append_chat_messages_batch([(user_id, chat_id, title, messages)])[0]
 
 
-def save_chat(user_id, chat_id, title, messages):
-    """Save a chat for a user"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def append_chat_messages_batch(entries):
+    """append_chat_messages() for several (user_id, chat_id, title, messages)
+    entries, in order, in one transaction
+
+    Returns a list with the result for each entry.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        created_at = datetime.now().isoformat()
+        
+        # Take the write lock up front so concurrent appends get consecutive seqs
+        c.execute('BEGIN IMMEDIATE')
+        results = [
+            _append_chat_messages(c, user_id, chat_id, title, messages, created_at)
+            for user_id, chat_id, title, messages in entries
+        ]
+        
+        conn.commit()
+    return results
+
+
+def _text(value):
+    """value with any lone surrogates replaced, since SQLite stores UTF-8 and
+    can't encode them (JSON allows them, so a request can carry one)"""
+    return value.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'replace')
+
+
+def _append_chat_messages(c, user_id, chat_id, title, messages, created_at):
+    c.execute('''
+        INSERT INTO chats (id, user_id, title, messages, created_at, message_count)
+        VALUES (?, ?, ?, '[]', ?, 0)
+        ON CONFLICT (id) DO UPDATE SET created_at = excluded.created_at
+        WHERE user_id = excluded.user_id
+    ''', (chat_id, user_id, _text(title), created_at))
     
-    messages_json = json.dumps(messages)
-    created_at = datetime.now().isoformat()
+    c.execute('SELECT message_count FROM chats WHERE id = ? AND user_id = ?', (chat_id, user_id))
+    result = c.fetchone()
+    if not result:
+        return False
     
+    start = result[0] or 0
+    c.executemany(
+        'INSERT INTO messages (chat_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)',
+        [(chat_id, start + i, msg['role'], _text(msg['content']), created_at) for i, msg in enumerate(messages)]
+    )
     c.execute('''
-        INSERT OR REPLACE INTO chats (id, user_id, title, messages, created_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (chat_id, user_id, title, messages_json, created_at))
-    
-    conn.commit()
-    conn.close()
+        INSERT INTO messages_fts (rowid, content)
+        SELECT id, content FROM messages WHERE chat_id = ? AND seq >= ?
+    ''', (chat_id, start))
+    c.execute('UPDATE chats SET message_count = ? WHERE id = ?', (start + len(messages), chat_id))
+    return True
 
 
-def get_user_chats(user_id):
-    """Get all chats for a user"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    c.execute('''
-        SELECT id, title, created_at 
-        FROM chats 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC
-    ''', (user_id,))
-    
-    results = c.fetchall()
-    conn.close()
+def get_user_chats(user_id, limit=None, before=None):
+    """Get a user's chats, newest first
+
+    limit caps how many are returned; before is the (created_at, id) of the
+    last chat of the previous page, and only older chats are returned.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        query = '''
+            SELECT id, title, created_at 
+            FROM chats 
+            WHERE user_id = ? 
+        '''
+        params = [user_id]
+        if before:
+            query += ' AND (created_at, id) < (?, ?)'
+            params.extend(before)
+        query += ' ORDER BY created_at DESC, id DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        
+        c.execute(query, params)
+        
+        results = c.fetchall()
     
     chats = []
     for row in results:
@@ -168,26 +529,659 @@ def get_user_chats(user_id):
     return chats
 
 
-def get_chat(chat_id, user_id):
-    """Get a specific chat"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def get_chat(chat_id, user_id, limit=None):
+    """Get a specific chat, with only its newest `limit` messages if given
+
+    Messages are numbered consecutively, so the first one returned has
+    seq message_count - len(messages).
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT id, title, created_at, summary, summarized_upto, message_count
+            FROM chats 
+            WHERE id = ? AND user_id = ?
+        ''', (chat_id, user_id))
+        
+        result = c.fetchone()
+        if not result:
+            return None
+        
+        if limit:
+            c.execute('''
+                SELECT role, content
+                FROM messages
+                WHERE chat_id = ?
+                ORDER BY seq DESC
+                LIMIT ?
+            ''', (chat_id, limit))
+            rows = c.fetchall()[::-1]
+        else:
+            c.execute('''
+                SELECT role, content
+                FROM messages
+                WHERE chat_id = ?
+                ORDER BY seq
+            ''', (chat_id,))
+            rows = c.fetchall()
+        
+        messages = [{'role': row[0], 'content': row[1]} for row in rows]
     
-    c.execute('''
-        SELECT id, title, messages, created_at 
-        FROM chats 
-        WHERE id = ? AND user_id = ?
-    ''', (chat_id, user_id))
+    return {
+        'id': result[0],
+        'title': result[1],
+        'messages': messages,
+        'created_at': result[2],
+        'summary': result[3],
+        'summarized_upto': result[4] or 0,
+        'message_count': result[5] or 0
+    }
+
+
+def get_chat_messages(chat_id, user_id, start_seq=0):
+    """Get a chat's messages from position start_seq on, with their seq"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT m.seq, m.role, m.content
+            FROM messages m
+            JOIN chats ch ON ch.id = m.chat_id
+            WHERE m.chat_id = ? AND ch.user_id = ? AND m.seq >= ?
+            ORDER BY m.seq
+        ''', (chat_id, user_id, start_seq))
+        
+        results = c.fetchall()
     
-    result = c.fetchone()
-    conn.close()
+    return [{'seq': row[0], 'role': row[1], 'content': row[2]} for row in results]
+
+
+def get_chat_messages_before(chat_id, user_id, before_seq, limit):
+    """Get up to `limit` of a chat's messages just before position before_seq, oldest first"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT m.seq, m.role, m.content
+            FROM messages m
+            JOIN chats ch ON ch.id = m.chat_id
+            WHERE m.chat_id = ? AND ch.user_id = ? AND m.seq < ?
+            ORDER BY m.seq DESC
+            LIMIT ?
+        ''', (chat_id, user_id, before_seq, limit))
+        
+        results = c.fetchall()
+    
+    return [{'seq': row[0], 'role': row[1], 'content': row[2]} for row in reversed(results)]
+
+
+def get_chat_summary(chat_id, user_id):
+    """Get a chat's rolling summary, the position it covers up to and the message count"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT summary, summarized_upto, message_count
+            FROM chats
+            WHERE id = ? AND user_id = ?
+        ''', (chat_id, user_id))
+        
+        result = c.fetchone()
+    
+    if result:
+        return {
+            'summary': result[0],
+            'summarized_upto': result[1] or 0,
+            'message_count': result[2] or 0
+        }
+    return None
+
+
+def update_chat_summary(chat_id, user_id, summary, summarized_upto, expected_upto):
+    """Store a new rolling summary unless another one was stored meanwhile
+
+    Returns True if the summary was stored.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            UPDATE chats SET summary = ?, summarized_upto = ?
+            WHERE id = ? AND user_id = ? AND summarized_upto = ?
+        ''', (summary, summarized_upto, chat_id, user_id, expected_upto))
+        updated = c.rowcount > 0
+        
+        conn.commit()
+    return updated
+
+
+
+def get_pdf_text(content_hash):
+    """Get cached text for a PDF by content hash"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('SELECT text FROM pdf_texts WHERE content_hash = ?', (content_hash,))
+        result = c.fetchone()
+    
+    if result:
+        return result[0]
+    return None
+
+
+def save_pdf_text(content_hash, text):
+    """Cache extracted text for a PDF
+
+    Returns False, saving nothing, if no user references the PDF any more.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        created_at = datetime.now().isoformat()
+        
+        c.execute('''
+            INSERT OR REPLACE INTO pdf_texts (content_hash, text, created_at)
+            SELECT ?, ?, ?
+            WHERE EXISTS (SELECT 1 FROM user_pdfs WHERE content_hash = ?)
+        ''', (content_hash, text, created_at, content_hash))
+        saved = c.rowcount > 0
+        
+        conn.commit()
+    
+    return saved
+
+
+def create_pdf_job(job_id, user_id, filename, content_hash):
+    """Record a queued PDF ingestion job"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        now = datetime.now().isoformat()
+        
+        c.execute('''
+            INSERT INTO pdf_jobs (id, user_id, filename, content_hash, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?)
+        ''', (job_id, user_id, filename, content_hash, now, now))
+        
+        conn.commit()
+
+
+def update_pdf_job(job_id, status, pages_done=None, pages_total=None, preview=None, error=None):
+    """Update status and progress of a PDF ingestion job"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            UPDATE pdf_jobs
+            SET status = ?,
+                pages_done = COALESCE(?, pages_done),
+                pages_total = COALESCE(?, pages_total),
+                preview = COALESCE(?, preview),
+                error = COALESCE(?, error),
+                updated_at = ?
+            WHERE id = ?
+        ''', (status, pages_done, pages_total, preview, error, datetime.now().isoformat(), job_id))
+        
+        conn.commit()
+
+
+def fail_stale_pdf_job(job_id, stale_before, error):
+    """Mark a job as failed if it is still queued or running with no progress since stale_before"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            UPDATE pdf_jobs
+            SET status = 'error', error = ?, updated_at = ?
+            WHERE id = ? AND status IN ('queued', 'running') AND updated_at < ?
+        ''', (error, datetime.now().isoformat(), job_id, stale_before))
+        
+        conn.commit()
+
+
+def get_pdf_job(job_id, user_id):
+    """Get a PDF ingestion job"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT id, filename, status, pages_done, pages_total, preview, error, created_at, updated_at
+            FROM pdf_jobs
+            WHERE id = ? AND user_id = ?
+        ''', (job_id, user_id))
+        
+        result = c.fetchone()
     
     if result:
         return {
             'id': result[0],
-            'title': result[1],
-            'messages': json.loads(result[2]),
+            'filename': result[1],
+            'status': result[2],
+            'pages_done': result[3],
+            'pages_total': result[4],
+            'preview': result[5],
+            'error': result[6],
+            'created_at': result[7],
+            'updated_at': result[8]
+        }
+    return None
+
+
+def add_user_pdf(user_id, filename, content_hash, size, uploaded_at=None, on_added=None):
+    """Record that a user has uploaded a stored PDF
+
+    on_added(), if given, runs before the reference is committed, while this
+    holds the write lock, so a concurrent remove_user_pdf() can't drop the
+    last reference to the same content in between.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        uploaded_at = uploaded_at or datetime.now().isoformat()
+        
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('''
+            INSERT OR IGNORE INTO user_pdfs (user_id, filename, content_hash, size, uploaded_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, filename, content_hash, size, uploaded_at))
+        if on_added:
+            on_added()
+        
+        conn.commit()
+
+
+def get_user_pdfs(user_id):
+    """Get all PDFs a user has uploaded, newest first"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT filename, content_hash, size, uploaded_at
+            FROM user_pdfs
+            WHERE user_id = ?
+            ORDER BY uploaded_at DESC
+        ''', (user_id,))
+        
+        results = c.fetchall()
+    
+    return [
+        {'filename': row[0], 'content_hash': row[1], 'size': row[2], 'uploaded': row[3]}
+        for row in results
+    ]
+
+
+def remove_user_pdf(user_id, filename, on_last_reference=None):
+    """Remove a user's reference to a PDF
+
+    When it was the last reference, the PDF's cached text, passage index and
+    recorded failure go in the same transaction, and on_last_reference(content_hash),
+    if given, runs before it commits (see add_user_pdf()).
+
+    Returns (content_hash, remaining references), or None if there was no such PDF.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('BEGIN IMMEDIATE')
+        c.execute(
+            'SELECT content_hash FROM user_pdfs WHERE user_id = ? AND filename = ?',
+            (user_id, filename)
+        )
+        result = c.fetchone()
+        
+        if not result:
+            return None
+        
+        content_hash = result[0]
+        c.execute('DELETE FROM user_pdfs WHERE user_id = ? AND filename = ?', (user_id, filename))
+        c.execute('SELECT COUNT(*) FROM user_pdfs WHERE content_hash = ?', (content_hash,))
+        remaining = c.fetchone()[0]
+        
+        if remaining == 0:
+            _delete_pdf_index(c, content_hash)
+            c.execute('DELETE FROM pdf_texts WHERE content_hash = ?', (content_hash,))
+            c.execute('DELETE FROM pdf_failures WHERE content_hash = ?', (content_hash,))
+            if on_last_reference:
+                on_last_reference(content_hash)
+        
+        conn.commit()
+    
+    return content_hash, remaining
+
+
+def save_pdf_index(content_hash, chunks):
+    """Replace the passage index for a PDF
+
+    chunks is a list of (text, length, term_counts) tuples in document order.
+    Returns False, saving nothing, if no user references the PDF any more.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('SELECT 1 FROM user_pdfs WHERE content_hash = ? LIMIT 1', (content_hash,))
+        if c.fetchone() is None:
+            return False
+        
+        _delete_pdf_index(c, content_hash)
+        
+        for seq, (text, length, term_counts) in enumerate(chunks):
+            c.execute('''
+                INSERT INTO pdf_chunks (content_hash, seq, text, length)
+                VALUES (?, ?, ?, ?)
+            ''', (content_hash, seq, text, length))
+            chunk_id = c.lastrowid
+            c.execute('INSERT INTO pdf_chunks_fts (rowid, text) VALUES (?, ?)', (chunk_id, text))
+            c.executemany(
+                'INSERT INTO pdf_terms (content_hash, term, chunk_id, tf) VALUES (?, ?, ?, ?)',
+                [(content_hash, term, chunk_id, tf) for term, tf in term_counts.items()]
+            )
+        c.execute(
+            'INSERT INTO pdf_index (content_hash, chunk_count, indexed_at) VALUES (?, ?, ?)',
+            (content_hash, len(chunks), datetime.now().isoformat())
+        )
+        
+        conn.commit()
+    
+    return True
+
+
+def _delete_pdf_index(c, content_hash):
+    c.execute('''
+        INSERT INTO pdf_chunks_fts (pdf_chunks_fts, rowid, text)
+        SELECT 'delete', id, text FROM pdf_chunks WHERE content_hash = ?
+    ''', (content_hash,))
+    c.execute('DELETE FROM pdf_terms WHERE content_hash = ?', (content_hash,))
+    c.execute('DELETE FROM pdf_index WHERE content_hash = ?', (content_hash,))
+    c.execute('DELETE FROM pdf_chunks WHERE content_hash = ?', (content_hash,))
+
+
+def get_unindexed_pdfs(user_id, active_since):
+    """Get (content_hash, filename) of a user's PDFs that have not been indexed
+
+    Skips PDFs whose extraction failed and PDFs with an ingestion job that
+    is queued or running and has made progress since active_since.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT u.content_hash, MIN(u.filename)
+            FROM user_pdfs u
+            WHERE u.user_id = ?
+              AND NOT EXISTS (SELECT 1 FROM pdf_index i WHERE i.content_hash = u.content_hash)
+              AND NOT EXISTS (SELECT 1 FROM pdf_failures f WHERE f.content_hash = u.content_hash)
+              AND NOT EXISTS (
+                  SELECT 1 FROM pdf_jobs j
+                  WHERE j.content_hash = u.content_hash
+                    AND j.status IN ('queued', 'running')
+                    AND j.updated_at >= ?
+              )
+            GROUP BY u.content_hash
+        ''', (user_id, active_since))
+        
+        results = c.fetchall()
+    
+    return results
+
+
+def record_pdf_failure(content_hash, error):
+    """Remember that a PDF's text could not be extracted, unless it has been deleted"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            INSERT OR REPLACE INTO pdf_failures (content_hash, error, failed_at)
+            SELECT ?, ?, ?
+            WHERE EXISTS (SELECT 1 FROM user_pdfs WHERE content_hash = ?)
+        ''', (content_hash, error, datetime.now().isoformat(), content_hash))
+        
+        conn.commit()
+
+
+def clear_pdf_failure(content_hash):
+    """Forget a recorded extraction failure, once the PDF has been read"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('DELETE FROM pdf_failures WHERE content_hash = ?', (content_hash,))
+        
+        conn.commit()
+
+
+def is_pdf_indexed(content_hash):
+    """Check whether a PDF has been indexed"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('SELECT 1 FROM pdf_index WHERE content_hash = ?', (content_hash,))
+        result = c.fetchone()
+    
+    return result is not None
+
+
+def get_pdf_index_stats(user_id):
+    """Get passage count and average passage length over a user's PDFs"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT COUNT(*), AVG(ch.length)
+            FROM (SELECT DISTINCT content_hash FROM user_pdfs WHERE user_id = ?) u
+            JOIN pdf_chunks ch ON ch.content_hash = u.content_hash
+        ''', (user_id,))
+        result = c.fetchone()
+    
+    return result[0], result[1] or 0
+
+
+def get_term_postings(user_id, terms):
+    """Get (term, chunk_id, tf, chunk length) postings for a user's passages"""
+    if not terms:
+        return []
+    
+    with connection() as conn:
+        c = conn.cursor()
+        
+        placeholders = ','.join('?' * len(terms))
+        c.execute(f'''
+            SELECT t.term, t.chunk_id, t.tf, ch.length
+            FROM (SELECT DISTINCT content_hash FROM user_pdfs WHERE user_id = ?) u
+            JOIN pdf_terms t ON t.content_hash = u.content_hash AND t.term IN ({placeholders})
+            JOIN pdf_chunks ch ON ch.id = t.chunk_id
+        ''', (user_id, *terms))
+        
+        results = c.fetchall()
+    
+    return results
+
+
+def get_pdf_chunks(chunk_ids):
+    """Get passages by id"""
+    if not chunk_ids:
+        return []
+    
+    with connection() as conn:
+        c = conn.cursor()
+        
+        placeholders = ','.join('?' * len(chunk_ids))
+        c.execute(f'''
+            SELECT id, content_hash, seq, text
+            FROM pdf_chunks
+            WHERE id IN ({placeholders})
+        ''', tuple(chunk_ids))
+        
+        results = c.fetchall()
+    
+    return [
+        {'id': row[0], 'content_hash': row[1], 'seq': row[2], 'text': row[3]}
+        for row in results
+    ]
+
+
+def get_leading_pdf_chunks(user_id):
+    """Get the first passage of each of a user's PDFs"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT id, content_hash, seq, text
+            FROM pdf_chunks
+            WHERE seq = 0
+              AND content_hash IN (SELECT content_hash FROM user_pdfs WHERE user_id = ?)
+        ''', (user_id,))
+        
+        results = c.fetchall()
+    
+    return [
+        {'id': row[0], 'content_hash': row[1], 'seq': row[2], 'text': row[3]}
+        for row in results
+    ]
+
+
+def _fts_query(text):
+    """FTS5 query matching all words of free text, the last one as a prefix"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def search_chat_messages(user_id, query, limit):
+    """Full-text search of a user's chat messages, best matches first"""
+    match = _fts_query(query)
+    if not match:
+        return []
+    
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT m.chat_id, ch.title, m.seq, m.role, m.created_at,
+                   snippet(messages_fts, 0, '[', ']', '...', ?)
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN chats ch ON ch.id = m.chat_id
+            WHERE messages_fts MATCH ? AND ch.user_id = ?
+            ORDER BY rank
+            LIMIT ?
+        ''', (SNIPPET_TOKENS, match, user_id, limit))
+        
+        results = c.fetchall()
+    
+    return [
+        {'chat_id': row[0], 'title': row[1], 'seq': row[2], 'role': row[3],
+         'created_at': row[4], 'snippet': row[5]}
+        for row in results
+    ]
+
+
+def search_pdf_passages(user_id, query, limit):
+    """Full-text search of the passages of a user's PDFs, best matches first"""
+    match = _fts_query(query)
+    if not match:
+        return []
+    
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT ch.content_hash, ch.seq,
+                   snippet(pdf_chunks_fts, 0, '[', ']', '...', ?)
+            FROM pdf_chunks_fts
+            JOIN pdf_chunks ch ON ch.id = pdf_chunks_fts.rowid
+            WHERE pdf_chunks_fts MATCH ?
+              AND ch.content_hash IN (SELECT content_hash FROM user_pdfs WHERE user_id = ?)
+            ORDER BY rank
+            LIMIT ?
+        ''', (SNIPPET_TOKENS, match, user_id, limit))
+        
+        results = c.fetchall()
+    
+    return [
+        {'content_hash': row[0], 'seq': row[1], 'snippet': row[2]}
+        for row in results
+    ]
+
+
+def claim_chat_request(user_id, key, fingerprint, stale_before):
+    """Claim an idempotency key for a chat request
+
+    A pending claim older than stale_before (a crashed worker) is dropped
+    first. Returns True if this caller now owns the key.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            DELETE FROM chat_requests
+            WHERE user_id = ? AND idempotency_key = ? AND status = 'pending' AND created_at < ?
+        ''', (user_id, key, stale_before))
+        c.execute('''
+            INSERT OR IGNORE INTO chat_requests (user_id, idempotency_key, fingerprint, status, created_at)
+            VALUES (?, ?, ?, 'pending', ?)
+        ''', (user_id, key, fingerprint, datetime.now().isoformat()))
+        claimed = c.rowcount > 0
+        
+        conn.commit()
+    return claimed
+
+
+def expire_chat_requests(expire_before):
+    """Drop idempotency entries older than expire_before"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('DELETE FROM chat_requests WHERE created_at < ?', (expire_before,))
+        
+        conn.commit()
+
+
+def get_chat_request(user_id, key):
+    """Get the state of an idempotent chat request"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT fingerprint, status, result, created_at
+            FROM chat_requests
+            WHERE user_id = ? AND idempotency_key = ?
+        ''', (user_id, key))
+        
+        result = c.fetchone()
+    
+    if result:
+        return {
+            'fingerprint': result[0],
+            'status': result[1],
+            'result': json.loads(result[2]) if result[2] else None,
             'created_at': result[3]
         }
     return None
 
+
+def complete_chat_request(user_id, key, result):
+    """Store the result of an idempotent chat request"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            UPDATE chat_requests SET status = 'done', result = ?
+            WHERE user_id = ? AND idempotency_key = ?
+        ''', (json.dumps(result), user_id, key))
+        
+        conn.commit()
+
+
+def release_chat_request(user_id, key):
+    """Give up a claimed idempotency key so a retry can run the request again"""
+    with connection() as conn:
+        c = conn.cursor()
+        
+        c.execute('''
+            DELETE FROM chat_requests
+            WHERE user_id = ? AND idempotency_key = ? AND status = 'pending'
+        ''', (user_id, key))
+        
+        conn.commit()
@@ -0,0 +1,314 @@
+"""
+Storage, text extraction, caching and retrieval for uploaded health documents
+"""
+import hashlib
+import math
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from PyPDF2 import PdfReader
+import database as db
+
+BASE_DIR = Path(__file__).parent
+PDFS_DIR = BASE_DIR / "user_data_web" / "user_pdfs"
+# Uploaded files are stored once per unique content, named by SHA-256
+BLOBS_DIR = PDFS_DIR / "blobs"
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1MB
+PREVIEW_CHARS = 200
+PROGRESS_INTERVAL = 0.5  # seconds between job progress writes
+
+# Passage retrieval (BM25)
+CHUNK_WORDS = 150  # words per indexed passage
+CHUNK_OVERLAP = 30  # words shared between neighbouring passages
+BM25_K1 = 1.5
+BM25_B = 0.75
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'for',
+    'from', 'has', 'have', 'how', 'i', 'if', 'in', 'is', 'it', 'its', 'me', 'my',
+    'of', 'on', 'or', 'should', 'so', 'that', 'the', 'this', 'to', 'was', 'what',
+    'when', 'which', 'with', 'you', 'your'
+}
+
+# Background ingestion runs outside the request/response cycle
+INGEST_WORKERS = int(os.environ.get('PDF_INGEST_WORKERS', '2'))
+_ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='pdf-ingest')
+# Jobs live in one worker's pool; one that has made no progress for this many
+# seconds is presumed lost with its worker
+PDF_JOB_TIMEOUT = int(os.environ.get('PDF_JOB_TIMEOUT', '600'))
+
+# (path, size, mtime) -> content hash, so unchanged files are not re-hashed
+_hash_memo = {}
+_hash_memo_lock = threading.Lock()
+
+
+def hash_file(pdf_path):
+    """Get the SHA-256 content hash of a file"""
+    stat = pdf_path.stat()
+    memo_key = (str(pdf_path), stat.st_size, stat.st_mtime_ns)
+
+    with _hash_memo_lock:
+        if memo_key in _hash_memo:
+            return _hash_memo[memo_key]
+
+    digest = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()
+
+    with _hash_memo_lock:
+        _hash_memo[memo_key] = content_hash
+
+    return content_hash
+
+
+def blob_path(content_hash):
+    """Path of the stored PDF with the given content hash"""
+    return BLOBS_DIR / content_hash[:2] / f"{content_hash}.pdf"
+
+
+def _place_blob(tmp_path, content_hash):
+    """Move a hashed temp file into the blob store, dropping it if already stored
+
+    Called while adding a reference to the content (see db.add_user_pdf), so
+    the blob can't be removed between this check and the reference landing.
+    """
+    path = blob_path(content_hash)
+    if path.exists():
+        os.unlink(tmp_path)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+
+
+def _remove_blob(content_hash):
+    """Delete a stored PDF, called as its last reference is removed"""
+    blob_path(content_hash).unlink(missing_ok=True)
+
+
+def store_pdf(user_id, filename, fileobj):
+    """Store an uploaded PDF under its content hash and add it to the user's documents
+
+    Returns (content_hash, size).
+    """
+    BLOBS_DIR.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, tmp_path = tempfile.mkstemp(dir=BLOBS_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: fileobj.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        content_hash = digest.hexdigest()
+        db.add_user_pdf(user_id, filename, content_hash, size,
+                        on_added=lambda: _place_blob(tmp_path, content_hash))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    return content_hash, size
+
+
+def release_pdf(user_id, filename):
+    """Remove a PDF from the user's documents, deleting it once nobody references it
+
+    Returns False if the user has no such PDF.
+    """
+    return db.remove_user_pdf(user_id, filename, on_last_reference=_remove_blob) is not None
+
+
+def migrate_legacy_pdfs():
+    """Move PDFs from the old per-user folders into the blob store"""
+    if not PDFS_DIR.exists():
+        return
+
+    for user_dir in PDFS_DIR.iterdir():
+        if not user_dir.is_dir() or not user_dir.name.isdigit():
+            continue
+        for pdf_file in user_dir.glob("*.pdf"):
+            try:
+                stat = pdf_file.stat()
+                content_hash = hash_file(pdf_file)
+                uploaded_at = datetime.fromtimestamp(stat.st_mtime).isoformat()
+                BLOBS_DIR.mkdir(parents=True, exist_ok=True)
+                db.add_user_pdf(int(user_dir.name), pdf_file.name, content_hash, stat.st_size, uploaded_at,
+                                on_added=lambda: _place_blob(pdf_file, content_hash))
+            except FileNotFoundError:
+                # Another worker migrated it first
+                continue
+
+
+def normalize_text(text):
+    """Tidy extracted text: strip trailing spaces and collapse blank runs"""
+    text = re.sub(r'[ \t]+\n', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip() + "\n"
+
+
+def iter_pdf_pages(pdf_path, progress=None):
+    """Yield the text of each page, parsing pages only as they are consumed"""
+    reader = PdfReader(pdf_path)
+    pages_total = len(reader.pages)
+    for i, page in enumerate(reader.pages):
+        yield (page.extract_text() or "") + "\n"
+        if progress:
+            progress(i + 1, pages_total)
+
+
+def make_preview(text):
+    """Short preview of a document's text"""
+    return text[:PREVIEW_CHARS] + "..." if len(text) > PREVIEW_CHARS else text
+
+
+def tokenize(text):
+    """Lowercase word terms used for indexing and queries"""
+    return [t for t in re.findall(r'[a-z0-9]+', text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+def chunk_text(text):
+    """Split text into overlapping passages of about CHUNK_WORDS words"""
+    words = text.split()
+    step = CHUNK_WORDS - CHUNK_OVERLAP
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + CHUNK_WORDS]))
+        if start + CHUNK_WORDS >= len(words):
+            break
+    return chunks
+
+
+def index_pdf_text(content_hash, text):
+    """Build the passage index for a PDF"""
+    chunks = []
+    for passage in chunk_text(text):
+        terms = tokenize(passage)
+        term_counts = {}
+        for term in terms:
+            term_counts[term] = term_counts.get(term, 0) + 1
+        chunks.append((passage, len(terms), term_counts))
+    db.save_pdf_index(content_hash, chunks)
+
+
+def job_stale_before():
+    """Jobs still queued or running with no progress since this time are presumed lost"""
+    return (datetime.now() - timedelta(seconds=PDF_JOB_TIMEOUT)).isoformat()
+
+
+def ensure_indexed(user_id):
+    """Index any of the user's PDFs that are missing from the passage index
+
+    This runs on the chat request path, so it never parses a PDF: text that
+    was already extracted is indexed here, anything else is handed to
+    background ingestion. PDFs with an ingestion job in progress or a
+    recorded extraction failure are left alone.
+    """
+    for content_hash, filename in db.get_unindexed_pdfs(user_id, job_stale_before()):
+        text = db.get_pdf_text(content_hash)
+        if text is not None:
+            index_pdf_text(content_hash, text)
+        else:
+            job_id = secrets.token_hex(16)
+            db.create_pdf_job(job_id, user_id, filename, content_hash)
+            submit_ingest(job_id, content_hash)
+
+
+def search_passages(user_id, query, top_k, max_chars=None):
+    """Get the user's most relevant passages for a query, within max_chars if given
+
+    Falls back to the opening passage of each document when nothing matches.
+    """
+    terms = list(set(tokenize(query)))
+    postings = db.get_term_postings(user_id, terms)
+
+    scores = {}
+    if postings:
+        n_chunks, avg_length = db.get_pdf_index_stats(user_id)
+        doc_freq = {}
+        for term, chunk_id, tf, length in postings:
+            doc_freq[term] = doc_freq.get(term, 0) + 1
+        for term, chunk_id, tf, length in postings:
+            idf = math.log(1 + (n_chunks - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / (avg_length or 1))
+            scores[chunk_id] = scores.get(chunk_id, 0) + idf * tf * (BM25_K1 + 1) / norm
+
+    if scores:
+        ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+        by_id = {chunk['id']: chunk for chunk in db.get_pdf_chunks(ranked)}
+        candidates = [by_id[chunk_id] for chunk_id in ranked if chunk_id in by_id]
+    else:
+        candidates = db.get_leading_pdf_chunks(user_id)[:top_k]
+
+    filenames = {}
+    for pdf in db.get_user_pdfs(user_id):
+        filenames.setdefault(pdf['content_hash'], pdf['filename'])
+
+    passages = []
+    used = 0
+    for chunk in candidates:
+        if max_chars is not None and used + len(chunk['text']) > max_chars:
+            continue
+        chunk['filename'] = filenames.get(chunk['content_hash'], 'document')
+        passages.append(chunk)
+        used += len(chunk['text'])
+    return passages
+
+
+def _ingest(job_id, content_hash):
+    """Extract, normalize, cache and index a PDF's text, recording progress on the job
+
+    Each unique document is only extracted and indexed once across all users.
+    """
+    try:
+        db.update_pdf_job(job_id, 'running')
+        last_update = [0.0]
+
+        def progress(pages_done, pages_total):
+            # Throttle progress writes so long documents don't hammer the database
+            now = time.monotonic()
+            if pages_done == pages_total or now - last_update[0] >= PROGRESS_INTERVAL:
+                last_update[0] = now
+                db.update_pdf_job(job_id, 'running', pages_done=pages_done, pages_total=pages_total)
+
+        text = db.get_pdf_text(content_hash)
+        if text is None:
+            pages = []
+            chars = 0
+            try:
+                for page_text in iter_pdf_pages(blob_path(content_hash), progress):
+                    pages.append(page_text)
+                    # Publish the preview as soon as the first pages cover it
+                    if chars <= PREVIEW_CHARS < chars + len(page_text):
+                        db.update_pdf_job(job_id, 'running', preview=make_preview(normalize_text("".join(pages))))
+                    chars += len(page_text)
+            except Exception as e:
+                # Not retried automatically; uploading the file again does retry
+                db.record_pdf_failure(content_hash, f"Error reading PDF: {str(e)}")
+                raise
+            text = normalize_text("".join(pages))
+            if not db.save_pdf_text(content_hash, text):
+                # Deleted while it was being read; nothing is kept for it
+                db.update_pdf_job(job_id, 'error', error="The PDF was deleted")
+                return
+            db.clear_pdf_failure(content_hash)
+
+        if not db.is_pdf_indexed(content_hash):
+            index_pdf_text(content_hash, text)
+        db.update_pdf_job(job_id, 'done', preview=make_preview(text))
+    except Exception as e:
+        db.update_pdf_job(job_id, 'error', error=f"Error reading PDF: {str(e)}")
+
+
+def submit_ingest(job_id, content_hash):
+    """Queue a stored PDF for background ingestion"""
+    return _ingest_pool.submit(_ingest, job_id, content_hash)
@@ -0,0 +1,201 @@
+"""
+Local fake of the OpenAI Responses API, for exercising hedging and the
+circuit breaker without calling (or paying for) the real provider
+
+Run it, then start the app with the OpenAI clients pointed at it:
+
+    python3 fake_provider.py --port 8099 --slow-rate 0.1 --slow-latency 30
+    OPENAI_BASE_URL=http://127.0.0.1:8099/v1 LLM_HEDGE=1 python3 web_app.py
+
+Any API key is accepted. Replies wait --latency seconds before their first
+byte, or --slow-latency for a --slow-rate share of requests (the slow tail
+hedging is for); --error-rate of requests fail with a 503, and with --down
+every request does (what trips the breaker). The same settings can be changed
+while it runs, e.g. to bring the provider back up for the breaker's trial call:
+
+    curl -X POST localhost:8099/fake/config -d '{"down": false}'
+
+GET /fake/stats counts the requests, slow replies and errors served so far.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8099
+CHUNK_DELAY = 0.02  # seconds between streamed words
+
+config = {
+    'latency': 0.2,
+    'slow_rate': 0.0,
+    'slow_latency': 30.0,
+    'error_rate': 0.0,
+    'down': False
+}
+stats = {'requests': 0, 'slow': 0, 'errors': 0}
+_lock = threading.Lock()
+
+
+def reply_text(body):
+    """A short reply quoting the end of the request's input"""
+    prompt = body.get('input', '')
+    if isinstance(prompt, list):
+        prompt = ' '.join(str(item.get('content', '')) for item in prompt if isinstance(item, dict))
+    words = str(prompt).split()
+    return "This is a fake reply to: " + " ".join(words[-12:])
+
+
+def response_object(model, text, status='completed'):
+    """A Responses API result holding text, as returned by responses.create()"""
+    input_tokens = 100
+    output_tokens = len(text.split())
+    return {
+        'id': f"resp_{uuid.uuid4().hex}",
+        'object': 'response',
+        'created_at': int(time.time()),
+        'status': status,
+        'model': model,
+        'output': [{
+            'type': 'message',
+            'id': f"msg_{uuid.uuid4().hex}",
+            'status': status,
+            'role': 'assistant',
+            'content': [{'type': 'output_text', 'text': text, 'annotations': []}]
+        }],
+        'parallel_tool_calls': True,
+        'tool_choice': 'auto',
+        'tools': [],
+        'usage': {
+            'input_tokens': input_tokens,
+            'input_tokens_details': {'cached_tokens': 0},
+            'output_tokens': output_tokens,
+            'output_tokens_details': {'reasoning_tokens': 0},
+            'total_tokens': input_tokens + output_tokens
+        }
+    }
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path == '/fake/stats':
+            with _lock:
+                self._send_json(200, dict(stats, config=config))
+        elif self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'gpt-fake', 'object': 'model'}]})
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def do_POST(self):
+        if self.path == '/fake/config':
+            changes = self._read_json()
+            with _lock:
+                config.update({key: value for key, value in changes.items() if key in config})
+                self._send_json(200, config)
+        elif self.path.rstrip('/').endswith('/responses'):
+            self._respond(self._read_json())
+        else:
+            self._send_json(404, {'error': {'message': 'Not found'}})
+
+    def _respond(self, body):
+        with _lock:
+            stats['requests'] += 1
+            failing = config['down'] or random.random() < config['error_rate']
+            slow = not failing and random.random() < config['slow_rate']
+            latency = config['slow_latency'] if slow else config['latency']
+            if failing:
+                stats['errors'] += 1
+            if slow:
+                stats['slow'] += 1
+
+        if failing:
+            self._send_json(503, {'error': {'message': 'The fake provider is down', 'type': 'server_error'}})
+            return
+
+        time.sleep(latency)
+        model = body.get('model', 'gpt-fake')
+        text = reply_text(body)
+        if not body.get('stream'):
+            self._send_json(200, response_object(model, text))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            self._stream(model, text)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client closed the stream, e.g. a losing hedge
+
+    def _stream(self, model, text):
+        sequence = 0
+
+        def event(payload):
+            nonlocal sequence
+            payload['sequence_number'] = sequence
+            sequence += 1
+            self.wfile.write(f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n".encode())
+            self.wfile.flush()
+
+        response = response_object(model, text)
+        item_id = response['output'][0]['id']
+        event({'type': 'response.created', 'response': dict(response, status='in_progress', output=[])})
+        for i, word in enumerate(text.split()):
+            if i:
+                time.sleep(CHUNK_DELAY)
+            event({
+                'type': 'response.output_text.delta',
+                'item_id': item_id,
+                'output_index': 0,
+                'content_index': 0,
+                'delta': word if i == 0 else ' ' + word
+            })
+        event({'type': 'response.completed', 'response': response})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake of the OpenAI Responses API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--latency', type=float, default=config['latency'],
+                        help='seconds before the first byte of a reply')
+    parser.add_argument('--slow-rate', type=float, default=config['slow_rate'],
+                        help='share of replies that are slow')
+    parser.add_argument('--slow-latency', type=float, default=config['slow_latency'],
+                        help='seconds before the first byte of a slow reply')
+    parser.add_argument('--error-rate', type=float, default=config['error_rate'],
+                        help='share of requests that fail with a 503')
+    parser.add_argument('--down', action='store_true', help='fail every request with a 503')
+    args = parser.parse_args()
+
+    config.update(latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                  error_rate=args.error_rate, down=args.down)
+    server = ThreadingHTTPServer((args.host, args.port), FakeProviderHandler)
+    server.daemon_threads = True
+    print(f"Fake OpenAI provider on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -21,6 +21,8 @@ from openai import OpenAI
 from pathlib import Path
 import PyPDF2
 import base64
+from llm import response_cache
+import context_builder
 
 # Prompt ID and version from your saved prompt
 PROMPT_ID = "pmpt_691a13bdf574819486553f3f13926e8606a7ec11e234cf1f"
@@ -743,19 +745,28 @@ class HealthChatbotApp:
     def get_ai_response(self, user_message):
         """Get response from OpenAI API"""
         try:
-            # Build context from user profile
-            context = self.build_context()
+            history = []
+            for msg in self.chat_history:
+                role = "User" if msg["role"] == "user" else "Assistant"
+                history.append(f"{role}: {msg['content']}\n")
             
-            # Build the full user message with context
-            full_message = f"{context}\n\nUser Question: {user_message}"
+            # Fill the token budget by priority: question, profile, PDFs, history.
+            # The question always goes last in the text itself.
+            full_message, _ = context_builder.assemble_context(
+                question=f"\n\nUser Question: {user_message}",
+                profile=self.build_context(),
+                documents=self.build_documents_context(),
+                history=history,
+                documents_header="\n\nUPLOADED MEDICAL DOCUMENTS:\n",
+                history_header="\n\nRecent Conversation:\n"
+            )
             
-            # Add chat history context
-            if self.chat_history:
-                history_text = "\n\nRecent Conversation:\n"
-                for msg in self.chat_history[-10:]:  # Last 10 messages
-                    role = "User" if msg["role"] == "user" else "Assistant"
-                    history_text += f"{role}: {msg['content']}\n"
-                full_message = history_text + "\n" + full_message
+            # Reuse a cached reply for an identical question (RESPONSE_CACHE=1)
+            cache_key = response_cache.make_key(PROMPT_ID, PROMPT_VERSION, full_message)
+            ai_message = response_cache.get(cache_key)
+            if ai_message is not None:
+                self.finish_ai_response(user_message, ai_message)
+                return
             
             # Call OpenAI API with the prompt ID
             response = client.responses.create(
@@ -797,6 +808,9 @@ class HealthChatbotApp:
                                         ai_message = content_item.text
                                         break  # Found it!
                 
+                if ai_message is not None:
+                    response_cache.put(cache_key, ai_message)
+                
                 # If extraction failed, use fallback
                 if ai_message is None:
                     print(f"WARNING: Could not extract text from response")
@@ -813,47 +827,31 @@ class HealthChatbotApp:
                 traceback.print_exc()
                 ai_message = f"Error: {str(extract_error)}"
             
-            # Update chat history - ensure strings only
-            self.chat_history.append({"role": "user", "content": str(user_message)})
-            self.chat_history.append({"role": "assistant", "content": str(ai_message)})
-            
-            # Save chat to disk
-            self.save_current_chat()
-            
-            # Add AI response to chat (in main thread)
-            self.app.after(0, self.add_message_to_chat, "AI Assistant", ai_message)
+            self.finish_ai_response(user_message, ai_message)
             
         except Exception as e:
             error_msg = f"Error: {str(e)}\n\nPlease check your API key and internet connection."
             self.app.after(0, self.add_message_to_chat, "System", error_msg)
     
-    def build_context(self):
-        """Build context from user profile and PDFs"""
-        context = "USER HEALTH INFORMATION:\n\n"
-        
-        # Add profile
-        for key, value in self.user_profile.items():
-            if key != 'created_at' and value:
-                context += f"{key.replace('_', ' ').title()}: {value}\n"
+    def finish_ai_response(self, user_message, ai_message):
+        """Record a reply in the chat history and show it"""
+        # Update chat history - ensure strings only
+        self.chat_history.append({"role": "user", "content": str(user_message)})
+        self.chat_history.append({"role": "assistant", "content": str(ai_message)})
         
-        # Add PDF information
-        if self.uploaded_pdfs:
-            context += "\n\nUPLOADED MEDICAL DOCUMENTS:\n"
-            for pdf_path in self.uploaded_pdfs:
-                context += f"\n- {Path(pdf_path).name}\n"
-                # Extract text from PDF (basic extraction)
-                try:
-                    with open(pdf_path, 'rb') as file:
-                        reader = PyPDF2.PdfReader(file)
-                        text = ""
-                        for page in reader.pages[:3]:  # First 3 pages only
-                            text += page.extract_text()
-                        context += f"Content preview: {text[:500]}...\n"
-                except:
-                    pass
+        # Save chat to disk
+        self.save_current_chat()
         
+        # Add AI response to chat (in main thread)
+        self.app.after(0, self.add_message_to_chat, "AI Assistant", ai_message)
+    
+    def build_context(self):
+        """Build context from reference books and user profile
+
+        Most stable parts first, so follow-up turns share a cacheable prefix.
+        """
         # Reference to available health books
-        context += "\n\nAVAILABLE HEALTH REFERENCE MATERIALS:\n"
+        context = "AVAILABLE HEALTH REFERENCE MATERIALS:\n"
         context += "- How Not to Die (Michael Greger)\n"
         context += "- Lifespan: Why We Age and Why We Don't Have To\n"
         context += "- Outlive: The Science and Art of Longevity\n"
@@ -863,8 +861,32 @@ class HealthChatbotApp:
         context += "- Blue Zones Study Guide\n"
         context += "- Ageless: The New Science of Getting Older Without Getting Old\n"
         
+        context += "\n\nUSER HEALTH INFORMATION:\n\n"
+        
+        # Add profile
+        for key, value in self.user_profile.items():
+            if key != 'created_at' and value:
+                context += f"{key.replace('_', ' ').title()}: {value}\n"
+        
         return context
     
+    def build_documents_context(self):
+        """Build one context block per uploaded PDF; the token budget decides how much is sent"""
+        documents = []
+        for pdf_path in self.uploaded_pdfs:
+            # Extract text from PDF (basic extraction)
+            try:
+                with open(pdf_path, 'rb') as file:
+                    reader = PyPDF2.PdfReader(file)
+                    text = ""
+                    for page in reader.pages[:3]:  # First 3 pages only
+                        text += page.extract_text()
+                documents.append(f"\n- {Path(pdf_path).name}\nContent preview: {text}...\n")
+            except:
+                pass
+        
+        return documents
+    
     def run(self):
         """Run the application"""
         self.app.mainloop()
@@ -0,0 +1,124 @@
+"""
+Idempotency keys for chat requests
+The client sends an Idempotency-Key header with each message and reuses it
+when retrying. The first request with a key claims it in the database and
+calls the model; duplicates, from any worker, wait for that call and get the
+same stored reply instead of triggering another call and another turn.
+"""
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import admission
+import database as db
+import llm
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))  # seconds a reply can be replayed
+IDEMPOTENCY_WAIT = int(os.environ.get('IDEMPOTENCY_WAIT', '120'))  # seconds a duplicate waits for the first
+# Seconds after which a pending claim is presumed dead (its worker crashed) and
+# can be taken over. It must outlast the owner's worst case: the admission
+# queue wait plus every attempt of the model call timing out.
+IDEMPOTENCY_STALE = int(os.environ.get(
+    'IDEMPOTENCY_STALE',
+    str(int(admission.QUEUE_TIMEOUT + (llm.CONNECT_TIMEOUT + llm.READ_TIMEOUT) * (llm.MAX_RETRIES + 1) + 30))
+))
+POLL_INTERVAL = 0.05  # first wait between polls; doubles up to MAX_POLL_INTERVAL
+MAX_POLL_INTERVAL = 1.0
+SWEEP_INTERVAL = 60  # seconds between sweeps of expired entries, per process
+MAX_KEY_LENGTH = 200
+
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+
+def fingerprint(user_message):
+    return hashlib.sha256(user_message.encode()).hexdigest()
+
+
+def _stale_before():
+    return (datetime.now() - timedelta(seconds=IDEMPOTENCY_STALE)).isoformat()
+
+
+def _sweep():
+    """Drop expired entries, at most once per SWEEP_INTERVAL"""
+    global _last_sweep
+    with _sweep_lock:
+        if time.monotonic() - _last_sweep < SWEEP_INTERVAL:
+            return
+        _last_sweep = time.monotonic()
+    db.expire_chat_requests((datetime.now() - timedelta(seconds=IDEMPOTENCY_TTL)).isoformat())
+
+
+def _entry_state(entry, fp):
+    if entry['fingerprint'] != fp:
+        return 'mismatch', None
+    if entry['status'] == 'done':
+        return 'done', entry['result']
+    return 'pending', None
+
+
+def check(user_id, key, user_message):
+    """Claim a key or look up its state
+
+    Returns (state, result) where state is 'owner' (caller must run the request
+    and then finish() or abandon()), 'done' (result is the stored reply),
+    'pending' (another request is running) or 'mismatch' (the key was used for
+    a different message).
+    """
+    _sweep()
+    fp = fingerprint(user_message)
+    if db.claim_chat_request(user_id, key, fp, _stale_before()):
+        return 'owner', None
+
+    entry = db.get_chat_request(user_id, key)
+    if entry is None:
+        # Released by a failed request between our claim and lookup
+        return 'pending', None
+    return _entry_state(entry, fp)
+
+
+def poll(user_id, key, user_message):
+    """check() for a key another request holds, reading until it can be claimed
+
+    Only writes (by claiming) once the holder released the key or its claim
+    went stale, so waiting duplicates don't compete for the database lock.
+    """
+    entry = db.get_chat_request(user_id, key)
+    if entry is None or (entry['status'] == 'pending' and entry['created_at'] < _stale_before()):
+        return check(user_id, key, user_message)
+    return _entry_state(entry, fingerprint(user_message))
+
+
+def acquire(user_id, key, user_message):
+    """Like check(), but wait while another request with the key is running
+
+    Returns 'timeout' as the state if it is still running after IDEMPOTENCY_WAIT.
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    interval = POLL_INTERVAL
+    state, result = check(user_id, key, user_message)
+    while state == 'pending':
+        if time.monotonic() >= deadline:
+            return 'timeout', None
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+        state, result = poll(user_id, key, user_message)
+    return state, result
+
+
+def finish(user_id, key, result):
+    db.complete_chat_request(user_id, key, result)
+
+
+def abandon(user_id, key):
+    db.release_chat_request(user_id, key)
+
+
+def replay(state, result):
+    """(payload, status) to answer a request whose key was not claimed"""
+    if state == 'done':
+        return result, 200
+    if state == 'mismatch':
+        return {'success': False, 'error': 'Idempotency key was already used for a different message'}, 422
+    return {'success': False, 'error': 'A request with this idempotency key is still in progress'}, 409
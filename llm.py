@@ -0,0 +1,281 @@
+"""
+OpenAI client management and reply caching
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from openai import AsyncOpenAI, OpenAI, Timeout
+
+# One client per API key keeps its HTTP connection pool (and TLS sessions) alive
+MAX_CLIENTS = int(os.environ.get('OPENAI_MAX_CLIENTS', '256'))
+
+# Bound how long a slow or unreachable provider can hold a worker (seconds)
+CONNECT_TIMEOUT = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.environ.get('OPENAI_READ_TIMEOUT', '60'))
+MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '2'))
+CLIENT_TIMEOUT = Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """Bounded LRU map of API key -> client
+
+    Evicted and discarded clients are only dropped from the map, not closed:
+    other requests may still be using them. Each client closes its connections
+    once the last reference to it goes away.
+    """
+
+    def __init__(self, factory, max_size):
+        self.factory = factory
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is not None:
+                self._clients.move_to_end(api_key)
+                return client
+
+        client = self.factory(api_key)
+
+        with self._lock:
+            # Another thread may have created one meanwhile; keep the first
+            existing = self._clients.get(api_key)
+            if existing is not None:
+                self._clients.move_to_end(api_key)
+                return existing
+
+            self._clients[api_key] = client
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+
+        return client
+
+    def discard(self, api_key):
+        with self._lock:
+            self._clients.pop(api_key, None)
+
+
+def _close_async_http_client(http_client, loop):
+    """Close an async client's HTTP pool, on the event loop it was used from"""
+    if http_client.is_closed:
+        return
+    try:
+        asyncio.get_running_loop().create_task(http_client.aclose())
+        return
+    except RuntimeError:
+        pass
+    if loop is not None and loop.is_running():
+        asyncio.run_coroutine_threadsafe(http_client.aclose(), loop)
+    elif loop is not None and loop.is_closed():
+        # Its connections belonged to the loop and went with it
+        pass
+    else:
+        logger.warning("Could not close an OpenAI async client: no event loop is running to close it on")
+
+
+def _new_client(api_key):
+    client = OpenAI(api_key=api_key, timeout=CLIENT_TIMEOUT, max_retries=MAX_RETRIES)
+    # Close the HTTP pool as soon as the last user of the client is done with it
+    weakref.finalize(client, client._client.close)
+    return client
+
+
+def _new_async_client(api_key):
+    client = AsyncOpenAI(api_key=api_key, timeout=CLIENT_TIMEOUT, max_retries=MAX_RETRIES)
+    # The async HTTP pool can't close itself outside a running loop, so close
+    # it on the loop that created the client once the client is collected
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    weakref.finalize(client, _close_async_http_client, client._client, loop)
+    return client
+
+
+_clients = ClientRegistry(_new_client, MAX_CLIENTS)
+_async_clients = ClientRegistry(_new_async_client, MAX_CLIENTS)
+
+
+def get_client(api_key):
+    """Get the shared client for an API key, creating it if needed"""
+    return _clients.get(api_key)
+
+
+def get_async_client(api_key):
+    """Get the shared async client for an API key (for the ASGI serving path)"""
+    return _async_clients.get(api_key)
+
+
+def discard_client(api_key):
+    """Drop the clients for an API key, e.g. when the key turns out to be invalid"""
+    _clients.discard(api_key)
+    _async_clients.discard(api_key)
+
+
+def prewarm_clients(api_keys):
+    """Create clients and open a connection for each key, ignoring failures"""
+    for api_key in api_keys:
+        try:
+            get_client(api_key).models.list()
+        except Exception:
+            discard_client(api_key)
+
+
+def extract_response_text(response):
+    """Get the assistant's text from a Responses API result, or None"""
+    if hasattr(response, 'output'):
+        output = response.output
+        if isinstance(output, list):
+            for item in output:
+                if hasattr(item, 'type') and item.type == 'message':
+                    message = item
+                elif hasattr(item, 'content') and not hasattr(item, 'type'):
+                    message = item
+                else:
+                    continue
+
+                if hasattr(message, 'content') and isinstance(message.content, list):
+                    if len(message.content) > 0:
+                        content_item = message.content[0]
+                        if hasattr(content_item, 'text'):
+                            return content_item.text
+    return None
+
+
+def extract_usage(response):
+    """Get token usage from a Responses API result, including cached input tokens"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return None
+
+    details = getattr(usage, 'input_tokens_details', None)
+    return {
+        'input_tokens': getattr(usage, 'input_tokens', None),
+        'cached_tokens': getattr(details, 'cached_tokens', 0) if details else 0,
+        'output_tokens': getattr(usage, 'output_tokens', None)
+    }
+
+
+def open_stream(stream):
+    """Wait for a stream's first event
+
+    Returns (stream, events), where events yields every event including the first.
+    """
+    iterator = iter(stream)
+    first = next(iterator, None)
+    return stream, itertools.chain([] if first is None else [first], iterator)
+
+
+async def open_async_stream(stream_coro):
+    """Async open_stream() for a pending responses.create(stream=True) call"""
+    stream = await stream_coro
+    iterator = stream.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        # Cancelled (e.g. a losing hedge) or failed: don't leave the connection open
+        if hasattr(stream, 'close'):
+            await stream.close()
+        raise
+
+    async def events():
+        if first is not None:
+            yield first
+        async for event in iterator:
+            yield event
+
+    return stream, events()
+
+
+def close_stream(opened):
+    """Close a stream from open_stream() or open_async_stream(); may return an awaitable"""
+    close = getattr(opened[0], 'close', None)
+    if close:
+        return close()
+
+
+class ResponseCache:
+    """In-memory LRU cache of model replies with a TTL
+
+    Keys hash the prompt id/version with the normalized model input, plus an
+    optional scope (e.g. a user id) for replies that must not be shared.
+    """
+
+    def __init__(self, enabled, ttl, max_entries):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(text):
+        """Case- and whitespace-insensitive form of a model input"""
+        return " ".join(text.casefold().split()).rstrip("?!. ")
+
+    def make_key(self, prompt_id, prompt_version, full_message, scope=None, model=None):
+        raw = json.dumps([prompt_id, prompt_version, model, scope, self.normalize(full_message)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        if not self.enabled or key is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, reply):
+        if not self.enabled or key is None:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+# Opt-in: RESPONSE_CACHE=1. Shared across users only with RESPONSE_CACHE_SHARED=1.
+response_cache = ResponseCache(
+    enabled=os.environ.get('RESPONSE_CACHE', '0') == '1',
+    ttl=int(os.environ.get('RESPONSE_CACHE_TTL', '3600')),
+    max_entries=int(os.environ.get('RESPONSE_CACHE_SIZE', '1000'))
+)
+RESPONSE_CACHE_SHARED = os.environ.get('RESPONSE_CACHE_SHARED', '0') == '1'
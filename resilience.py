@@ -0,0 +1,295 @@
+"""
+Hedged requests and a circuit breaker for model calls
+Hedging: if the first byte of a reply hasn't arrived after the hedge delay
+(LLM_HEDGE_AFTER seconds, or the observed p95 time to first byte when that
+is 0), a second identical request is sent and whichever answers first wins.
+Only calls whose losing copy can be stopped at its first byte are hedged
+(streams, closed by their discard callback); a plain call would run to the
+end and be paid for twice, outside its admission slot.
+The breaker: after LLM_BREAKER_FAILURES consecutive provider failures
+(timeouts, connection errors, 5xx), calls fail fast with a 503 for
+LLM_BREAKER_RESET seconds, then a single trial call decides whether to close
+it again.
+
+To exercise both against a local fake provider, run fake_provider.py and point
+the OpenAI clients at it with OPENAI_BASE_URL (see that module for the knobs).
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import openai
+import admission
+
+HEDGE_ENABLED = os.environ.get('LLM_HEDGE', '0') == '1'
+HEDGE_AFTER = float(os.environ.get('LLM_HEDGE_AFTER', '0'))  # 0 = use the observed p95
+HEDGE_MIN_SAMPLES = 20
+BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', '5'))
+BREAKER_RESET = float(os.environ.get('LLM_BREAKER_RESET', '30'))
+
+# Errors that say the provider is unhealthy, as opposed to a bad request or key
+PROVIDER_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    TimeoutError
+)
+
+
+class LatencyTracker:
+    """Rolling window of latency samples"""
+
+    def __init__(self, size=500):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p):
+        """The p-th percentile of the window, or None if it is empty"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, math.ceil(p / 100 * len(samples)) - 1)]
+
+    def count(self):
+        with self._lock:
+            return len(self._samples)
+
+
+class CircuitBreaker:
+    """Fail fast while the provider keeps failing"""
+
+    def __init__(self, failure_threshold, reset_timeout, is_failure):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _rejection(self):
+        retry_after = max(1, math.ceil(self._opened_at + self.reset_timeout - time.monotonic()))
+        return admission.AdmissionRejected(
+            503, 'The AI provider is not responding right now. Please try again shortly.', retry_after)
+
+    def check(self):
+        """Raise AdmissionRejected if a call would be refused right now"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._trial_running or time.monotonic() < self._opened_at + self.reset_timeout:
+                raise self._rejection()
+
+    def allow(self):
+        """Let a call through or raise AdmissionRejected; once the reset
+        timeout passes, a single trial call is let through
+
+        Returns whether the call is that trial, to pass on to record() or
+        abandon() so only the trial frees its slot.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if self._trial_running or time.monotonic() < self._opened_at + self.reset_timeout:
+                raise self._rejection()
+            self._trial_running = True
+            return True
+
+    def abandon(self, trial=False):
+        """A call was given up (the client went away): says nothing about the
+        provider, so only free the trial slot if it held it"""
+        with self._lock:
+            if trial:
+                self._trial_running = False
+
+    def record(self, error=None, trial=False):
+        with self._lock:
+            if trial:
+                self._trial_running = False
+            if error is None or not self.is_failure(error):
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() < self._opened_at + self.reset_timeout:
+                return 'open'
+            return 'half-open'
+
+
+class Hedger:
+    """Runs a call, sending a backup copy if the first is slow to answer"""
+
+    def __init__(self, enabled, hedge_after, tracker, executor=None):
+        self.enabled = enabled
+        self.hedge_after = hedge_after
+        self.tracker = tracker
+        self.executor = executor
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """Seconds to wait for the first byte before hedging, or None to not hedge"""
+        if not self.enabled:
+            return None
+        if self.hedge_after > 0:
+            return self.hedge_after
+        if self.tracker.count() < HEDGE_MIN_SAMPLES:
+            return None
+        return self.tracker.percentile(95)
+
+    def _timed(self, attempt):
+        start = time.monotonic()
+        result = attempt()
+        self.tracker.add(time.monotonic() - start)
+        return result
+
+    def call(self, attempt, discard=None):
+        """Run attempt() (blocking); discard(result) stops a losing copy.
+        Without discard the call is never hedged, nor timed: only calls that
+        return at their first byte (streams) measure first-byte latency."""
+        if not discard:
+            return attempt()
+        delay = self.delay()
+        if delay is None:
+            return self._timed(attempt)
+
+        first = self.executor.submit(self._timed, attempt)
+        if wait([first], timeout=delay).done:
+            return first.result()
+
+        self.hedges += 1
+        futures = [first, self.executor.submit(self._timed, attempt)]
+        winner = None
+        error = None
+        pending = set(futures)
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in futures:
+                if future in done and future.exception() is None:
+                    winner = future
+                    break
+                if future in done:
+                    error = future.exception()
+        if winner is None:
+            raise error
+
+        if winner is not first:
+            self.hedge_wins += 1
+        # The losing call can't be interrupted from here; clean up whenever it returns
+        for future in futures:
+            if future is not winner and discard:
+                future.add_done_callback(lambda f: f.exception() is None and discard(f.result()))
+        return winner.result()
+
+    async def acall(self, attempt, discard=None):
+        """Async call(): attempt() returns an awaitable and discard may be async.
+        The losing copy is cancelled. Without discard the call is never hedged."""
+        async def timed():
+            start = time.monotonic()
+            result = await attempt()
+            self.tracker.add(time.monotonic() - start)
+            return result
+
+        if not discard:
+            return await attempt()
+        delay = self.delay()
+        if delay is None:
+            return await timed()
+
+        first = asyncio.ensure_future(timed())
+        tasks = [first]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(timed()))
+
+            error = None
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None:
+                        winner = task
+                        break
+                    if task in done:
+                        error = task.exception()
+            if winner is None:
+                raise error
+
+            if winner is not first:
+                self.hedge_wins += 1
+            return winner.result()
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif discard and not task.cancelled() and task.exception() is None:
+                    cleanup = discard(task.result())
+                    if asyncio.iscoroutine(cleanup):
+                        await cleanup
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'delay': self.delay(),
+            'p95_first_byte': self.tracker.percentile(95),
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins
+        }
+
+
+first_byte_latency = LatencyTracker()
+breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET, lambda e: isinstance(e, PROVIDER_ERRORS))
+hedger = Hedger(HEDGE_ENABLED, HEDGE_AFTER, first_byte_latency,
+                ThreadPoolExecutor(max_workers=32, thread_name_prefix='llm-hedge'))
+
+
+def call(attempt, discard=None):
+    """Call the provider through the circuit breaker, hedging slow first bytes of
+    calls that can be discarded"""
+    trial = breaker.allow()
+    try:
+        result = hedger.call(attempt, discard)
+    except Exception as e:
+        breaker.record(e, trial)
+        raise
+    except BaseException:
+        breaker.abandon(trial)
+        raise
+    breaker.record(trial=trial)
+    return result
+
+
+async def acall(attempt, discard=None):
+    """Async call()"""
+    trial = breaker.allow()
+    try:
+        result = await hedger.acall(attempt, discard)
+    except Exception as e:
+        breaker.record(e, trial)
+        raise
+    except BaseException:
+        # Cancelled (client went away): says nothing about the provider
+        breaker.abandon(trial)
+        raise
+    breaker.record(trial=trial)
+    return result
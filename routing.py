@@ -0,0 +1,94 @@
+"""
+Routing chat turns between a fast tier and a strong tier
+Cheap local heuristics (question length and wording, how much document text
+went into the context, how deep the conversation is) decide whether a turn
+needs the strong tier; small talk and short follow-ups go to the fast one.
+"""
+import re
+import time
+from resilience import LatencyTracker
+
+# "thanks!", "ok", "hello" and the like never need the strong tier
+SMALL_TALK = re.compile(
+    r"^(hi|hello|hey|thanks|thank you|thx|ok|okay|cool|great|got it|bye|goodbye|good (morning|night))\b[\w\s!.,']{0,20}$",
+    re.IGNORECASE
+)
+# Wording that usually means careful reading or medical reasoning
+STRONG_TERMS = re.compile(
+    r"\b(lab|labs|result|results|interpret|analy[sz]e|dose|dosage|medication|drug|symptoms?|diagnos\w*|"
+    r"blood|test|levels?|cholesterol|glucose|a1c|pressure|compare|explain why|plan)\b",
+    re.IGNORECASE
+)
+LONG_QUESTION_TOKENS = 40
+MANY_DOCUMENT_TOKENS = 1000
+DEEP_HISTORY_MESSAGES = 12
+STRONG_SCORE = 2
+
+
+class Tier:
+    """A prompt (and optionally a model override) requests can be routed to"""
+
+    def __init__(self, name, prompt_id, prompt_version, model=None):
+        self.name = name
+        self.prompt_id = prompt_id
+        self.prompt_version = prompt_version
+        self.model = model
+        self.latency = LatencyTracker()
+
+    def request_args(self):
+        """Keyword arguments for responses.create()"""
+        args = {'prompt': {'id': self.prompt_id, 'version': self.prompt_version}}
+        if self.model:
+            args['model'] = self.model
+        return args
+
+    def stats(self):
+        return {
+            'requests': self.latency.count(),
+            'p50': self.latency.percentile(50),
+            'p95': self.latency.percentile(95)
+        }
+
+
+class Router:
+    def __init__(self, enabled, fast, strong):
+        self.enabled = enabled
+        self.fast = fast
+        self.strong = strong
+
+    def score(self, user_message, context_tokens, history_messages):
+        """How much a turn needs the strong tier; STRONG_SCORE or more routes it there"""
+        if SMALL_TALK.match(user_message.strip()):
+            return 0
+
+        score = 0
+        if context_tokens['question'] > LONG_QUESTION_TOKENS:
+            score += 2
+        elif context_tokens['question'] > LONG_QUESTION_TOKENS // 3:
+            score += 1
+        if STRONG_TERMS.search(user_message):
+            score += 2
+        if context_tokens['documents'] > MANY_DOCUMENT_TOKENS:
+            score += 1
+        if history_messages > DEEP_HISTORY_MESSAGES:
+            score += 1
+        return score
+
+    def choose(self, user_message, context_tokens, history_messages):
+        """Pick the tier for a turn"""
+        if not self.enabled:
+            return self.strong
+        if self.score(user_message, context_tokens, history_messages) >= STRONG_SCORE:
+            return self.strong
+        return self.fast
+
+    def record(self, tier, started):
+        """Record a finished call's latency, given its time.monotonic() start"""
+        tier.latency.add(time.monotonic() - started)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            self.fast.name: self.fast.stats(),
+            self.strong.name: self.strong.stats()
+        }
@@ -0,0 +1,103 @@
+"""
+Rolling summaries of long conversations
+Once a chat has more than SUMMARY_THRESHOLD messages past its summary, all
+but the newest SUMMARY_KEEP_RECENT are folded into a running summary stored
+with the chat, so the prompt stays the same size however long the chat gets.
+
+The model call takes one of the user's admission slots and goes through the
+circuit breaker like a chat reply; when it is turned away the summary is
+simply left for a later turn.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import admission
+import database as db
+import llm
+import resilience
+
+SUMMARY_THRESHOLD = int(os.environ.get('CHAT_SUMMARY_THRESHOLD', '20'))
+SUMMARY_KEEP_RECENT = int(os.environ.get('CHAT_SUMMARY_KEEP_RECENT', '10'))
+SUMMARY_MODEL = os.environ.get('CHAT_SUMMARY_MODEL', 'gpt-4o-mini')
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and a "
+    "health assistant. Merge the new messages into the existing summary. Keep "
+    "every health fact, symptom, measurement, decision, recommendation and open "
+    "question the user may refer back to. Write concise plain text, no preamble."
+)
+
+SUMMARY_WORKERS = int(os.environ.get('CHAT_SUMMARY_WORKERS', '2'))
+_summary_pool = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='chat-summary')
+
+# Chats with a summary update queued or running in this process
+_pending = set()
+_pending_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def unsummarized_start(state, offset):
+    """Index of the first message not covered by the summary, in a list of the
+    chat's messages from position offset on"""
+    if not state:
+        return 0
+    return max(state['summarized_upto'] - offset, 0)
+
+
+def format_messages(messages):
+    lines = []
+    for msg in messages:
+        role = "User" if msg["role"] == "user" else "Assistant"
+        lines.append(f"{role}: {msg['content']}\n")
+    return "".join(lines)
+
+
+def summarize(client, previous_summary, messages):
+    """Fold messages into the previous summary with the model"""
+    text = ""
+    if previous_summary:
+        text += f"EXISTING SUMMARY:\n{previous_summary}\n\n"
+    text += f"NEW MESSAGES:\n{format_messages(messages)}"
+
+    response = resilience.call(lambda: client.responses.create(
+        model=SUMMARY_MODEL,
+        instructions=SUMMARY_INSTRUCTIONS,
+        input=text
+    ))
+    return llm.extract_response_text(response)
+
+
+def update_summary(api_key, user_id, chat_id):
+    """Fold a chat's older messages into its summary if it has grown past the threshold"""
+    try:
+        state = db.get_chat_summary(chat_id, user_id)
+        if not state:
+            return
+
+        messages = db.get_chat_messages(chat_id, user_id, state['summarized_upto'])
+        end = len(messages) - SUMMARY_KEEP_RECENT
+        if len(messages) <= SUMMARY_THRESHOLD or end <= 0:
+            return
+
+        with admission.scheduler.slot(user_id):
+            summary = summarize(llm.get_client(api_key), state['summary'], messages[:end])
+        if summary:
+            db.update_chat_summary(chat_id, user_id, summary,
+                                   messages[end - 1]['seq'] + 1, state['summarized_upto'])
+    except admission.AdmissionRejected as e:
+        logger.info("Summary of chat %s deferred: %s", chat_id, e.message)
+    except Exception:
+        logger.exception("Error summarizing chat %s", chat_id)
+    finally:
+        with _pending_lock:
+            _pending.discard((user_id, chat_id))
+
+
+def schedule_summary(api_key, user_id, chat_id):
+    """Update a chat's summary in the background, at most one update per chat at a time"""
+    with _pending_lock:
+        if (user_id, chat_id) in _pending:
+            return
+        _pending.add((user_id, chat_id))
+    _summary_pool.submit(update_summary, api_key, user_id, chat_id)
@@ -0,0 +1,96 @@
+"""
+In-process cache of logged-in users
+Flask-Login loads the user on every authenticated request; this keeps the
+loaded user in memory so most requests skip the database entirely.
+
+Entries are stamped with the cache generation they were loaded in and only
+served while it is current. invalidate() bumps the generation, both here and
+in every other worker process: it replaces a small signal file, and each
+lookup compares the file's stat stamp with the last one seen. An entry also
+expires USER_CACHE_TTL seconds after it was loaded, whatever happens.
+"""
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '4096'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '300'))
+
+
+class UserCache:
+    """Bounded LRU of loader(user_id) results, invalidated across processes"""
+
+    def __init__(self, loader, signal_path, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.loader = loader
+        self.signal_path = signal_path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user id -> (generation, loaded at, user)
+        self._generation = 0
+        self._signal_stamp = self._read_signal()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _read_signal(self):
+        try:
+            st = os.stat(self.signal_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _current_generation(self):
+        """The generation, bumped first if another process signalled since the last look"""
+        stamp = self._read_signal()
+        with self._lock:
+            if stamp != self._signal_stamp:
+                self._signal_stamp = stamp
+                self._generation += 1
+            return self._generation
+
+    def get(self, user_id):
+        """The cached user, loading it on a miss; None if there is no such user"""
+        generation = self._current_generation()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] == generation and now - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        # Stamped with the generation from before the read, so an invalidation
+        # that lands while loading makes this entry stale straight away
+        user = self.loader(user_id)
+        if user is None:
+            return None
+
+        with self._lock:
+            self._entries[user_id] = (generation, now, user)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        """Drop a user after their account changed, in this and every other process"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._generation += 1
+        self._signal()
+
+    def _signal(self):
+        # Replacing the file gives it a new inode, so every change is seen
+        # even within the filesystem's timestamp resolution
+        directory = os.path.dirname(self.signal_path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.user_cache')
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(time.time_ns()))
+        os.replace(tmp_path, self.signal_path)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
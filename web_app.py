@@ -3,7 +3,7 @@ Health AI Assistant - Web Application
 A mobile-friendly web version accessible from any device
 """
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, send_file, stream_with_context
 from flask_session import Session
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
@@ -11,10 +11,21 @@ import os
 from pathlib import Path
 from datetime import datetime
 import json
-from openai import OpenAI
 import secrets
+import threading
+import time
+from collections import OrderedDict
+import admission
+import chat_writer
+import context_builder
 import database as db
-from PyPDF2 import PdfReader
+import documents as docs
+import idempotency
+import llm
+import resilience
+import routing
+import summaries
+import user_cache
 
 app = Flask(__name__)
 # Use environment variable for production, random for development
@@ -32,16 +43,18 @@ PDFS_DIR.mkdir(exist_ok=True)
 # File upload configuration
 ALLOWED_EXTENSIONS = {'pdf'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+MAX_REQUEST_SIZE = MAX_FILE_SIZE + 1024 * 1024  # largest upload plus multipart overhead
+RETRIEVAL_TOP_K = 5  # Most relevant PDF passages offered to the context budget
+SESSION_HISTORY_MESSAGES = 50  # Newest messages kept in the session
+MESSAGES_PAGE = 30  # Messages per page when loading a chat
+MESSAGES_MAX_PAGE = 100
+CHAT_HISTORY_PAGE = 30  # Chats per page of the history list
+CHAT_HISTORY_MAX_PAGE = 100
+SEARCH_RESULTS = 20  # Matches per kind returned by /api/search
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_user_pdf_dir(user_id):
-    """Get or create user's PDF directory"""
-    user_dir = PDFS_DIR / str(user_id)
-    user_dir.mkdir(exist_ok=True)
-    return user_dir
-
 # Configure server-side sessions (inside user_data_web)
 SESSION_DIR = USER_DATA_DIR / 'sessions'
 SESSION_DIR.mkdir(exist_ok=True)
@@ -54,8 +67,14 @@ app.config['REMEMBER_COOKIE_DURATION'] = 86400  # 24 hours
 app.config['SESSION_COOKIE_SECURE'] = True  # HTTPS only
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE
 Session(app)
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'success': False, 'error': 'File too large (max 10MB)'}), 413
+
+
 # Configure Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -64,30 +83,69 @@ login_manager.session_protection = "strong"
 
 # Initialize database
 db.init_db()
+docs.migrate_legacy_pdfs()
+
+# Optionally open provider connections for recently active users at startup
+PREWARM_CLIENTS = int(os.environ.get('OPENAI_PREWARM_CLIENTS', '0'))
+if PREWARM_CLIENTS:
+    threading.Thread(
+        target=llm.prewarm_clients,
+        args=(db.get_recent_api_keys(PREWARM_CLIENTS),),
+        daemon=True
+    ).start()
 
 class User(UserMixin):
-    def __init__(self, id, email, api_key=None, profile=None):
+    def __init__(self, id, email, api_key=None, profile=None, profile_version=0):
         self.id = id
         self.email = email
         self.api_key = api_key
         self.profile = profile
+        self.profile_version = profile_version
 
 
-@login_manager.user_loader
-def load_user(user_id):
+def fetch_user(user_id):
     user_data = db.get_user(user_id)
     if user_data:
         return User(
             id=user_data['id'],
             email=user_data['email'],
             api_key=user_data['api_key'],
-            profile=user_data['profile']
+            profile=user_data['profile'],
+            profile_version=user_data['profile_version']
         )
     return None
 
+
+# Loaded users, shared by requests; drop a user with users.invalidate() after changing their account
+users = user_cache.UserCache(fetch_user, USER_DATA_DIR / "user_cache.signal")
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    try:
+        return users.get(int(user_id))
+    except ValueError:
+        return None
+
 # Prompt ID from your saved prompt
 PROMPT_ID = "pmpt_691a13bdf574819486553f3f13926e8606a7ec11e234cf1f"
 PROMPT_VERSION = "1"
+# Small talk and short follow-ups can go to a faster tier (LLM_ROUTING=1)
+router = routing.Router(
+    enabled=os.environ.get('LLM_ROUTING', '0') == '1',
+    fast=routing.Tier(
+        'fast',
+        os.environ.get('LLM_FAST_PROMPT_ID', PROMPT_ID),
+        os.environ.get('LLM_FAST_PROMPT_VERSION', PROMPT_VERSION),
+        model=os.environ.get('LLM_FAST_MODEL')
+    ),
+    strong=routing.Tier('strong', PROMPT_ID, PROMPT_VERSION)
+)
+FALLBACK_REPLY = "I received your message but had trouble generating a response. Please try again."
+INTERRUPTED_NOTE = "[Reply interrupted: the connection closed before it finished.]"
+# Include token usage (including provider-cached input tokens) and the
+# context budget breakdown in chat responses
+REPORT_TOKEN_USAGE = os.environ.get('REPORT_TOKEN_USAGE', '0') == '1'
 
 
 @app.route('/')
@@ -138,7 +196,8 @@ def api_signup():
         id=user_data['id'],
         email=user_data['email'],
         api_key=user_data['api_key'],
-        profile=user_data['profile']
+        profile=user_data['profile'],
+        profile_version=user_data['profile_version']
     )
     login_user(user, remember=True)
     session.permanent = True
@@ -166,7 +225,8 @@ def api_login():
         id=user_data['id'],
         email=user_data['email'],
         api_key=user_data['api_key'],
-        profile=user_data['profile']
+        profile=user_data['profile'],
+        profile_version=user_data['profile_version']
     )
     login_user(user, remember=True)
     session.permanent = True
@@ -198,16 +258,18 @@ def save_api_key():
     
     # Test the API key
     try:
-        client = OpenAI(api_key=api_key)
+        client = llm.get_client(api_key)
         # Quick test call
         client.models.list()
         
         # Save to database
         db.update_api_key(current_user.id, api_key)
+        users.invalidate(current_user.id)
         current_user.api_key = api_key
         
         return jsonify({'success': True})
     except Exception as e:
+        llm.discard_client(api_key)
         return jsonify({'success': False, 'error': f'Invalid API key: {str(e)}'})
 
 
@@ -250,11 +312,14 @@ def save_profile():
     }
     
     db.update_profile(current_user.id, profile)
+    users.invalidate(current_user.id)
     current_user.profile = profile
+    invalidate_context_prefix(current_user.id)
     
     # Initialize first chat
     session['current_chat_id'] = datetime.now().strftime("%Y%m%d_%H%M%S")
     session['chat_history'] = []
+    session['chat_offset'] = 0
     
     return jsonify({'success': True})
 
@@ -273,117 +338,418 @@ def chat():
     if 'current_chat_id' not in session:
         session['current_chat_id'] = datetime.now().strftime("%Y%m%d_%H%M%S")
         session['chat_history'] = []
+        session['chat_offset'] = 0
     
     return render_template('chat.html', profile=current_user.profile)
 
 
-@app.route('/api/chat', methods=['POST'])
-@login_required
-def chat_api():
-    """Handle chat messages"""
+REFERENCE_MATERIALS = (
+    "AVAILABLE HEALTH REFERENCE MATERIALS:\n"
+    "- How Not to Die (Michael Greger)\n"
+    "- Lifespan: Why We Age and Why We Don't Have To\n"
+    "- Outlive: The Science and Art of Longevity\n"
+    "- The China Study\n"
+    "- The Longevity Paradox\n"
+    "- Blue Zones Study Guide\n"
+)
+
+# Compiled profile + reference block per user, stamped with the profile version
+MAX_CONTEXT_PREFIXES = 1024
+_context_prefixes = OrderedDict()
+_context_prefixes_lock = threading.Lock()
+
+
+def compile_context_prefix(profile):
+    """Build the reference materials and user health information block
+
+    The static reference list comes first so every user's input starts with
+    the same bytes, then the profile, which is stable across a user's turns.
+    """
+    lines = [REFERENCE_MATERIALS, "\n\nUSER HEALTH INFORMATION:\n\n"]
+    for key, value in profile.items():
+        if key != 'created_at' and value:
+            lines.append(f"{key.replace('_', ' ').title()}: {value}\n")
+    return "".join(lines)
+
+
+def get_context_prefix(user):
+    """Get the compiled context prefix for a user, rebuilding it if the profile changed"""
+    with _context_prefixes_lock:
+        entry = _context_prefixes.get(user.id)
+        if entry is not None and entry[0] == user.profile_version:
+            _context_prefixes.move_to_end(user.id)
+            return entry[1]
+    
+    prefix = compile_context_prefix(user.profile or {})
+    
+    with _context_prefixes_lock:
+        _context_prefixes[user.id] = (user.profile_version, prefix)
+        _context_prefixes.move_to_end(user.id)
+        while len(_context_prefixes) > MAX_CONTEXT_PREFIXES:
+            _context_prefixes.popitem(last=False)
+    
+    return prefix
+
+
+def invalidate_context_prefix(user_id):
+    """Drop a user's compiled context prefix after a profile change"""
+    with _context_prefixes_lock:
+        _context_prefixes.pop(user_id, None)
+
+
+def build_chat_input(user_message):
+    """Build the model input: references, profile, documents, history and question
+
+    Parts are ordered from most to least stable so consecutive turns share
+    the longest possible prefix, which lets provider-side prompt caching hit.
+    What goes in is decided by the token budget, filled by priority:
+    question, then profile, then relevant documents, then the summary of
+    older turns, then recent history.
+
+    Returns (full_message, token breakdown).
+    """
+    chat_history = session.get('chat_history', [])
+    
+    # Turns already folded into the chat's running summary are not resent
+    summary = ""
+    start = 0
+    if chat_history and session.get('current_chat_id'):
+        state = db.get_chat_summary(session['current_chat_id'], current_user.id)
+        if state and state['summary']:
+            summary = f"\n\nSummary of Earlier Conversation:\n{state['summary']}\n"
+            start = summaries.unsummarized_start(state, session.get('chat_offset', 0))
+    
+    history = []
+    for msg in chat_history[start:]:
+        role = "User" if msg["role"] == "user" else "Assistant"
+        history.append(f"{role}: {msg['content']}\n")
+    
+    return context_builder.assemble_context(
+        question=f"\n\nUser Question: {user_message}",
+        # Reference list and profile only change with the profile
+        profile=get_context_prefix(current_user),
+        documents=get_user_pdfs_context(current_user.id, user_message),
+        history=history,
+        documents_header=DOCUMENTS_HEADER,
+        history_header="\n\nRecent Conversation:\n",
+        summary=summary
+    )
+
+
+def route_chat(user_message, context_tokens):
+    """Pick the routing tier for this turn"""
+    return router.choose(user_message, context_tokens, len(session.get('chat_history', [])))
+
+
+def chat_cache_key(full_message, tier):
+    """Response cache key for this turn, or None when caching is off
+
+    Turns that carry chat history or documents are always scoped to the user.
+    Generic turns are shared between users only if RESPONSE_CACHE_SHARED is set.
+    """
+    if not llm.response_cache.enabled:
+        return None
+    
+    scope = f"user:{current_user.id}"
+    if llm.RESPONSE_CACHE_SHARED and not session.get('chat_history') and not db.get_user_pdfs(current_user.id):
+        scope = None
+    
+    return llm.response_cache.make_key(tier.prompt_id, tier.prompt_version, full_message, scope, tier.model)
+
+
+def record_chat_turn(user_message, ai_message):
+    """Append a turn to the session history and save the chat"""
+    if 'chat_history' not in session:
+        session['chat_history'] = []
+    
+    turn = [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": ai_message}
+    ]
+    session['chat_history'].extend(turn)
+    
+    # Keep only last 50 messages in the session; the database keeps them all.
+    # chat_offset is the position in the chat of the first one kept.
+    dropped = max(len(session['chat_history']) - SESSION_HISTORY_MESSAGES, 0)
+    if dropped:
+        session['chat_history'] = session['chat_history'][dropped:]
+        session['chat_offset'] = session.get('chat_offset', 0) + dropped
+    session.modified = True
+    
+    # Save the turn to the database
+    save_chat_to_db(session, current_user.id, turn)
+    
+    if session.get('current_chat_id'):
+        summaries.schedule_summary(current_user.api_key, current_user.id, session['current_chat_id'])
+
+
+def interrupted_reply(partial):
+    """What is recorded for a reply cut off by a client disconnect"""
+    if partial:
+        return f"{partial}\n\n{INTERRUPTED_NOTE}"
+    return INTERRUPTED_NOTE
+
+
+def parse_chat_request():
+    """Get the user's message, or an error response if it can't be answered"""
     if not current_user.api_key:
-        return jsonify({'success': False, 'error': 'No API key'})
+        return None, jsonify({'success': False, 'error': 'No API key'})
     
     data = request.json
+    # Lone surrogates are valid in JSON but can't be encoded as UTF-8 to be
+    # hashed, sent to the model or stored, so replace them up front
     user_message = data.get('message', '').strip()
+    user_message = user_message.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'replace')
     
     if not user_message:
-        return jsonify({'success': False, 'error': 'Empty message'})
+        return None, jsonify({'success': False, 'error': 'Empty message'})
+    
+    return user_message, None
+
+
+def get_idempotency_key():
+    """The client's Idempotency-Key header, or None if it didn't send a usable one"""
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if not key or len(key) > idempotency.MAX_KEY_LENGTH:
+        return None
+    return key
+
+
+def save_session_now():
+    """Save the session outside the normal response cycle (e.g. after streaming)"""
+    app.session_interface.save_session(app, session, app.response_class())
+
+
+@app.route('/api/chat', methods=['POST'])
+@login_required
+def chat_api():
+    """Handle chat messages"""
+    user_message, error = parse_chat_request()
+    if error:
+        return error
+    
+    # Duplicate sends share the first request's reply instead of calling the model again
+    idempotency_key = get_idempotency_key()
+    if idempotency_key:
+        state, stored = idempotency.acquire(current_user.id, idempotency_key, user_message)
+        if state != 'owner':
+            payload, status = idempotency.replay(state, stored)
+            return jsonify(payload), status
     
     try:
-        # Build context from user profile
-        profile = current_user.profile or {}
-        context = "USER HEALTH INFORMATION:\n\n"
-        
-        for key, value in profile.items():
-            if key != 'created_at' and value:
-                context += f"{key.replace('_', ' ').title()}: {value}\n"
-        
-        context += "\n\nAVAILABLE HEALTH REFERENCE MATERIALS:\n"
-        context += "- How Not to Die (Michael Greger)\n"
-        context += "- Lifespan: Why We Age and Why We Don't Have To\n"
-        context += "- Outlive: The Science and Art of Longevity\n"
-        context += "- The China Study\n"
-        context += "- The Longevity Paradox\n"
-        context += "- Blue Zones Study Guide\n"
-        
-        # Add user's uploaded PDFs to context
-        pdfs_context = get_user_pdfs_context(current_user.id)
-        context += pdfs_context
-        
-        # Build full message with context
-        full_message = f"{context}\n\nUser Question: {user_message}"
-        
-        # Add chat history
-        chat_history = session.get('chat_history', [])
-        if chat_history:
-            history_text = "\n\nRecent Conversation:\n"
-            for msg in chat_history[-10:]:
-                role = "User" if msg["role"] == "user" else "Assistant"
-                history_text += f"{role}: {msg['content']}\n"
-            full_message = history_text + "\n" + full_message
-        
-        # Call OpenAI API
-        client = OpenAI(api_key=current_user.api_key)
-        response = client.responses.create(
-            prompt={
-                "id": PROMPT_ID,
-                "version": PROMPT_VERSION
-            },
-            input=full_message
-        )
-        
-        # Extract AI response
-        ai_message = None
-        if hasattr(response, 'output'):
-            output = response.output
-            if isinstance(output, list):
-                for item in output:
-                    if hasattr(item, 'type') and item.type == 'message':
-                        message = item
-                    elif hasattr(item, 'content') and not hasattr(item, 'type'):
-                        message = item
-                    else:
-                        continue
-                    
-                    if hasattr(message, 'content') and isinstance(message.content, list):
-                        if len(message.content) > 0:
-                            content_item = message.content[0]
-                            if hasattr(content_item, 'text'):
-                                ai_message = content_item.text
-                                break
+        full_message, context_tokens = build_chat_input(user_message)
+        tier = route_chat(user_message, context_tokens)
+        cache_key = chat_cache_key(full_message, tier)
+        ai_message = llm.response_cache.get(cache_key)
+        usage = None
         
         if ai_message is None:
-            ai_message = "I received your message but had trouble generating a response. Please try again."
-        
-        # Update chat history
-        if 'chat_history' not in session:
-            session['chat_history'] = []
-        
-        session['chat_history'].append({"role": "user", "content": user_message})
-        session['chat_history'].append({"role": "assistant", "content": ai_message})
-        
-        # Keep only last 50 messages
-        if len(session['chat_history']) > 50:
-            session['chat_history'] = session['chat_history'][-50:]
+            # Call OpenAI API, waiting for a free slot if the server is busy
+            client = llm.get_client(current_user.api_key)
+            with admission.scheduler.slot(current_user.id):
+                started = time.monotonic()
+                response = resilience.call(lambda: client.responses.create(
+                    **tier.request_args(),
+                    input=full_message
+                ))
+                router.record(tier, started)
+            
+            # Extract AI response
+            ai_message = llm.extract_response_text(response)
+            usage = llm.extract_usage(response)
+            
+            if ai_message is None:
+                ai_message = FALLBACK_REPLY
+            else:
+                llm.response_cache.put(cache_key, ai_message)
         
-        session.modified = True
+        record_chat_turn(user_message, ai_message)
         
-        # Save chat to database
-        save_chat_to_db(session, current_user.id)
-        
-        return jsonify({
+        result = {
             'success': True,
             'message': ai_message
-        })
+        }
+        if REPORT_TOKEN_USAGE:
+            result['usage'] = usage
+            result['context_tokens'] = context_tokens
+            result['tier'] = tier.name
+        if idempotency_key:
+            idempotency.finish(current_user.id, idempotency_key, result)
+        return jsonify(result)
         
+    except admission.AdmissionRejected as e:
+        if idempotency_key:
+            idempotency.abandon(current_user.id, idempotency_key)
+        return rejected_response(e)
+    
     except Exception as e:
+        if idempotency_key:
+            idempotency.abandon(current_user.id, idempotency_key)
         return jsonify({
             'success': False,
             'error': f'Error: {str(e)}'
         })
 
 
+def rejected_response(rejection):
+    """Fast 429/503 for a chat request turned away by admission control"""
+    response = jsonify({'success': False, 'error': rejection.message})
+    response.status_code = rejection.status
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response
+
+
+def sse_event(payload):
+    """Format a Server-Sent Event carrying a JSON payload"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    """Handle chat messages, streaming the reply as Server-Sent Events"""
+    user_message, error = parse_chat_request()
+    if error:
+        return error
+    
+    idempotency_key = get_idempotency_key()
+    if idempotency_key:
+        state, stored = idempotency.acquire(current_user.id, idempotency_key, user_message)
+        if state == 'done':
+            return sse_response(replay_reply(stored))
+        if state != 'owner':
+            payload, status = idempotency.replay(state, stored)
+            return jsonify(payload), status
+    
+    try:
+        full_message, context_tokens = build_chat_input(user_message)
+        tier = route_chat(user_message, context_tokens)
+        cache_key = chat_cache_key(full_message, tier)
+        cached = llm.response_cache.get(cache_key)
+        client = llm.get_client(current_user.api_key)
+        # Take a model call slot before any headers go out, so a busy server can still say 429/503
+        if cached is None:
+            resilience.breaker.check()
+            admission.scheduler.acquire(current_user.id)
+    except admission.AdmissionRejected as e:
+        if idempotency_key:
+            idempotency.abandon(current_user.id, idempotency_key)
+        return rejected_response(e)
+    except Exception as e:
+        if idempotency_key:
+            idempotency.abandon(current_user.id, idempotency_key)
+        return jsonify({'success': False, 'error': f'Error: {str(e)}'})
+    
+    def finish(result):
+        if idempotency_key:
+            idempotency.finish(current_user.id, idempotency_key, result)
+    
+    def generate():
+        parts = []
+        usage = None
+        if cached is not None:
+            record_chat_turn(user_message, cached)
+            save_session_now()
+            finish({'success': True, 'message': cached})
+            yield sse_event({'type': 'delta', 'text': cached})
+            yield sse_event({'type': 'done', 'message': cached})
+            return
+        
+        opened = None
+        started = time.monotonic()
+        try:
+            # Hedging races copies of the request on their first event
+            opened = resilience.call(
+                lambda: llm.open_stream(client.responses.create(
+                    **tier.request_args(),
+                    input=full_message,
+                    stream=True
+                )),
+                discard=llm.close_stream
+            )
+            for event in opened[1]:
+                if event.type == 'response.output_text.delta':
+                    parts.append(event.delta)
+                    yield sse_event({'type': 'delta', 'text': event.delta})
+                elif event.type == 'response.completed':
+                    usage = llm.extract_usage(event.response)
+        except GeneratorExit:
+            # The server closes the stream when the client goes away: stop the
+            # upstream generation and keep what was said in the history
+            if opened is not None:
+                llm.close_stream(opened)
+            record_chat_turn(user_message, interrupted_reply("".join(parts)))
+            save_session_now()
+            if idempotency_key:
+                idempotency.abandon(current_user.id, idempotency_key)
+            raise
+        except Exception as e:
+            if idempotency_key:
+                idempotency.abandon(current_user.id, idempotency_key)
+            yield sse_event({'type': 'error', 'error': f'Error: {str(e)}'})
+            return
+        
+        router.record(tier, started)
+        ai_message = "".join(parts)
+        if ai_message:
+            llm.response_cache.put(cache_key, ai_message)
+        else:
+            ai_message = FALLBACK_REPLY
+        record_chat_turn(user_message, ai_message)
+        # The response headers are already sent, so save the session explicitly
+        save_session_now()
+        
+        done = {'type': 'done', 'message': ai_message}
+        if REPORT_TOKEN_USAGE:
+            done['usage'] = usage
+            done['context_tokens'] = context_tokens
+            done['tier'] = tier.name
+        finish({'success': True, 'message': ai_message})
+        yield sse_event(done)
+    
+    response = sse_response(generate())
+    if cached is None:
+        # Released when the server closes the response, even if the stream never started
+        user_id = current_user.id
+        response.call_on_close(lambda: admission.scheduler.release(user_id))
+    return response
+
+
+def replay_reply(result):
+    """Send a stored reply as a single-delta event stream"""
+    yield sse_event({'type': 'delta', 'text': result['message']})
+    yield sse_event({'type': 'done', 'message': result['message']})
+
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/api/response-cache-stats')
+@login_required
+def response_cache_stats():
+    """Get response cache hit-rate stats for this worker"""
+    return jsonify({'success': True, 'stats': llm.response_cache.stats()})
+
+
+@app.route('/api/llm-stats')
+@login_required
+def llm_stats():
+    """Get circuit breaker, hedging, per-tier latency, user cache and chat writer stats for this worker"""
+    return jsonify({
+        'success': True,
+        'breaker': resilience.breaker.state(),
+        'hedging': resilience.hedger.stats(),
+        'routing': router.stats(),
+        'user_cache': users.stats(),
+        'chat_writer': chat_writer.writer.stats()
+    })
+
+
 @app.route('/api/profile')
 @login_required
 def get_profile():
@@ -394,24 +760,67 @@ def get_profile():
     })
 
 
+def chat_window(limit, before=None):
+    """Up to `limit` messages of the current chat before position `before`
+    (default: the end), oldest first, each with its seq
+
+    Returns (messages, cursor), where cursor is the `before` for the next
+    older page, or None at the start of the chat. The newest messages come
+    from the session, older ones from the database.
+    """
+    history = session.get('chat_history', [])
+    offset = session.get('chat_offset', 0)
+    end = offset + len(history)
+    if before is None or before > end:
+        before = end
+    start = max(before - limit, 0)
+    
+    messages = [
+        dict(msg, seq=offset + i)
+        for i, msg in enumerate(history)
+        if start <= offset + i < before
+    ]
+    if start < offset and session.get('current_chat_id'):
+        older_before = min(before, offset)
+        messages = db.get_chat_messages_before(
+            session['current_chat_id'], current_user.id, older_before, older_before - start
+        ) + messages
+    
+    cursor = messages[0]['seq'] if messages and messages[0]['seq'] > 0 else None
+    return messages, cursor
+
+
+def get_messages_page_args():
+    """(limit, before) query parameters for paged message loading"""
+    limit = request.args.get('limit', MESSAGES_PAGE, type=int)
+    return max(1, min(limit, MESSAGES_MAX_PAGE)), request.args.get('before', type=int)
+
+
 @app.route('/api/get-messages')
 @login_required
 def get_messages():
-    """Get current chat messages"""
+    """Get a page of the current chat's messages
+
+    Query parameters: limit (default MESSAGES_PAGE) and before, a message
+    position; without it the newest messages are returned. Pass the
+    returned `before` back to get the page before this one.
+    """
+    messages, cursor = chat_window(*get_messages_page_args())
     return jsonify({
         'success': True,
-        'messages': session.get('chat_history', [])
+        'messages': messages,
+        'before': cursor
     })
 
 
-def save_chat_to_db(session_obj, user_id):
-    """Save current chat to database"""
-    if not session_obj.get('current_chat_id') or not session_obj.get('chat_history'):
+def save_chat_to_db(session_obj, user_id, new_messages):
+    """Queue new messages of the current chat to be appended to the database"""
+    if not session_obj.get('current_chat_id') or not new_messages:
         return
     
     chat_id = session_obj['current_chat_id']
     
-    # Generate title from first user message
+    # Generate title from first user message (only used when the chat is created)
     title = "New Chat"
     for msg in session_obj['chat_history']:
         if msg['role'] == 'user':
@@ -420,20 +829,17 @@ def save_chat_to_db(session_obj, user_id):
                 title += "..."
             break
     
-    db.save_chat(user_id, chat_id, title, session_obj['chat_history'])
+    chat_writer.writer.append(user_id, chat_id, title, new_messages)
 
 
 @app.route('/api/new-chat', methods=['POST'])
 @login_required
 def new_chat():
     """Start a new chat"""
-    # Save current chat before starting new one
-    if session.get('chat_history'):
-        save_chat_to_db(session, current_user.id)
-    
     # Create new chat
     session['current_chat_id'] = datetime.now().strftime("%Y%m%d_%H%M%S")
     session['chat_history'] = []
+    session['chat_offset'] = 0
     session.modified = True
     
     return jsonify({'success': True})
@@ -442,25 +848,83 @@ def new_chat():
 @app.route('/api/chat-history')
 @login_required
 def get_chat_history():
-    """Get list of saved chats"""
-    chats = db.get_user_chats(current_user.id)
-    return jsonify({'success': True, 'chats': chats})
+    """Get a page of saved chats, newest first
+
+    Query parameters: limit (default CHAT_HISTORY_PAGE) and before, the
+    next_cursor of the previous page. next_cursor is None on the last page.
+    """
+    limit = request.args.get('limit', CHAT_HISTORY_PAGE, type=int)
+    limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE))
+    
+    before = None
+    cursor = request.args.get('before')
+    if cursor:
+        created_at, sep, chat_id = cursor.partition('|')
+        if not sep:
+            return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+        before = (created_at, chat_id)
+    
+    # One extra row tells whether there is another page
+    chat_writer.writer.flush(current_user.id)
+    chats = db.get_user_chats(current_user.id, limit + 1, before)
+    next_cursor = None
+    if len(chats) > limit:
+        chats = chats[:limit]
+        next_cursor = f"{chats[-1]['created_at']}|{chats[-1]['id']}"
+    
+    return jsonify({'success': True, 'chats': chats, 'next_cursor': next_cursor})
+
+
+@app.route('/api/search')
+@login_required
+def search():
+    """Full-text search of the user's chats and uploaded documents
+
+    Returns the best matching messages (with chat id and position) and
+    document passages, each with a snippet where matches are in [brackets].
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'success': False, 'error': 'No search query provided'}), 400
+    limit = request.args.get('limit', SEARCH_RESULTS, type=int)
+    limit = max(1, min(limit, SEARCH_RESULTS))
+    
+    chat_writer.writer.flush(current_user.id)
+    messages = db.search_chat_messages(current_user.id, query, limit)
+    
+    passages = db.search_pdf_passages(current_user.id, query, limit)
+    filenames = {}
+    for pdf in db.get_user_pdfs(current_user.id):
+        filenames.setdefault(pdf['content_hash'], pdf['filename'])
+    documents = [
+        {'filename': filenames.get(p['content_hash'], 'document'), 'passage': p['seq'], 'snippet': p['snippet']}
+        for p in passages
+    ]
+    
+    return jsonify({'success': True, 'messages': messages, 'documents': documents})
 
 
 @app.route('/api/load-chat/<chat_id>')
 @login_required
 def load_chat(chat_id):
-    """Load a specific chat"""
-    chat_data = db.get_chat(chat_id, current_user.id)
+    """Load a specific chat
+
+    Makes it the current chat and returns its newest page of messages
+    (same query parameters and `before` cursor as /api/get-messages).
+    """
+    chat_writer.writer.flush(current_user.id)
+    chat_data = db.get_chat(chat_id, current_user.id, SESSION_HISTORY_MESSAGES)
     
     if not chat_data:
         return jsonify({'success': False, 'error': 'Chat not found'})
     
-    # Load into session
+    # Load the newest messages into the session
     session['current_chat_id'] = chat_data['id']
     session['chat_history'] = chat_data['messages']
+    session['chat_offset'] = chat_data['message_count'] - len(chat_data['messages'])
     session.modified = True
     
+    chat_data['messages'], chat_data['before'] = chat_window(*get_messages_page_args())
     return jsonify({'success': True, 'chat': chat_data})
 
 
@@ -468,13 +932,10 @@ def load_chat(chat_id):
 @login_required
 def clear_chat():
     """Clear chat history"""
-    # Save current chat before clearing
-    if session.get('chat_history'):
-        save_chat_to_db(session, current_user.id)
-    
     # Start new chat
     session['current_chat_id'] = datetime.now().strftime("%Y%m%d_%H%M%S")
     session['chat_history'] = []
+    session['chat_offset'] = 0
     session.modified = True
     return jsonify({'success': True})
 
@@ -488,18 +949,6 @@ def logout_route():
     return redirect(url_for('index'))
 
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from PDF file"""
-    try:
-        reader = PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        return f"Error reading PDF: {str(e)}"
-
-
 @app.route('/api/upload-pdf', methods=['POST'])
 @login_required
 def upload_pdf():
@@ -524,50 +973,61 @@ def upload_pdf():
         if file_size > MAX_FILE_SIZE:
             return jsonify({'success': False, 'error': 'File too large (max 10MB)'})
         
-        # Save file
         filename = secure_filename(file.filename)
-        user_pdf_dir = get_user_pdf_dir(current_user.id)
         
         # Add timestamp to filename to avoid conflicts
         name, ext = os.path.splitext(filename)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         unique_filename = f"{name}_{timestamp}{ext}"
         
-        filepath = user_pdf_dir / unique_filename
-        file.save(filepath)
+        # Save file (stored once per unique content)
+        content_hash, _ = docs.store_pdf(current_user.id, unique_filename, file.stream)
         
-        # Extract text for preview
-        text = extract_text_from_pdf(filepath)
-        preview = text[:200] + "..." if len(text) > 200 else text
+        # Extract text in the background; the client polls /api/pdf-status
+        job_id = secrets.token_hex(16)
+        db.create_pdf_job(job_id, current_user.id, unique_filename, content_hash)
+        docs.submit_ingest(job_id, content_hash)
         
         return jsonify({
             'success': True,
             'filename': unique_filename,
             'original_name': file.filename,
-            'preview': preview
+            'job_id': job_id,
+            'status': 'queued'
         })
     
     except Exception as e:
         return jsonify({'success': False, 'error': f'Upload failed: {str(e)}'})
 
 
+@app.route('/api/pdf-status/<job_id>')
+@login_required
+def pdf_status(job_id):
+    """Get progress of a PDF ingestion job"""
+    job = db.get_pdf_job(job_id, current_user.id)
+    
+    if not job:
+        return jsonify({'success': False, 'error': 'Job not found'})
+    
+    # Jobs run in one worker's pool and are lost if it restarts; report those as failed
+    stale_before = docs.job_stale_before()
+    if job['status'] in ('queued', 'running') and job['updated_at'] < stale_before:
+        db.fail_stale_pdf_job(job_id, stale_before,
+                              "Reading the document was interrupted. Please upload it again.")
+        job = db.get_pdf_job(job_id, current_user.id)
+    
+    return jsonify({'success': True, 'job': job})
+
+
 @app.route('/api/list-pdfs')
 @login_required
 def list_pdfs():
     """List user's uploaded PDFs"""
     try:
-        user_pdf_dir = get_user_pdf_dir(current_user.id)
-        pdfs = []
-        
-        for pdf_file in user_pdf_dir.glob("*.pdf"):
-            pdfs.append({
-                'filename': pdf_file.name,
-                'size': pdf_file.stat().st_size,
-                'uploaded': datetime.fromtimestamp(pdf_file.stat().st_mtime).isoformat()
-            })
-        
-        # Sort by upload date (newest first)
-        pdfs.sort(key=lambda x: x['uploaded'], reverse=True)
+        pdfs = [
+            {'filename': pdf['filename'], 'size': pdf['size'], 'uploaded': pdf['uploaded']}
+            for pdf in db.get_user_pdfs(current_user.id)
+        ]
         
         return jsonify({'success': True, 'pdfs': pdfs})
     
@@ -582,43 +1042,35 @@ def delete_pdf(filename):
     try:
         # Security: ensure filename is safe
         safe_filename = secure_filename(filename)
-        user_pdf_dir = get_user_pdf_dir(current_user.id)
-        filepath = user_pdf_dir / safe_filename
         
-        if not filepath.exists():
+        # The stored file is only removed once no user references it
+        if not docs.release_pdf(current_user.id, safe_filename):
             return jsonify({'success': False, 'error': 'File not found'})
         
-        filepath.unlink()
         return jsonify({'success': True})
     
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 
-def get_user_pdfs_context(user_id):
-    """Get text content from all user's PDFs for AI context"""
+DOCUMENTS_HEADER = "\n\nUSER'S UPLOADED HEALTH DOCUMENTS (most relevant excerpts):\n\n"
+
+
+def get_user_pdfs_context(user_id, query):
+    """Get the passages of the user's PDFs most relevant to the query, best first"""
     try:
-        user_pdf_dir = get_user_pdf_dir(user_id)
-        context = "\n\nUSER'S UPLOADED HEALTH DOCUMENTS:\n\n"
-        
-        pdf_files = list(user_pdf_dir.glob("*.pdf"))
-        
-        if not pdf_files:
-            return ""
-        
-        for pdf_file in pdf_files:
-            context += f"\n--- Document: {pdf_file.name} ---\n"
-            text = extract_text_from_pdf(pdf_file)
-            # Limit to first 2000 chars per PDF to avoid context overflow
-            context += text[:2000]
-            if len(text) > 2000:
-                context += "\n[...document continues...]"
-            context += "\n\n"
+        # PDFs uploaded before indexing existed are indexed on first use, in the background
+        docs.ensure_indexed(user_id)
+        passages = docs.search_passages(user_id, query, RETRIEVAL_TOP_K)
         
-        return context
+        return [
+            f"\n--- Document: {passage['filename']} (excerpt {passage['seq'] + 1}) ---\n"
+            f"{passage['text']}\n\n"
+            for passage in passages
+        ]
     
     except Exception as e:
-        return f"\nError loading documents: {str(e)}\n"
+        return [f"\nError loading documents: {str(e)}\n"]
 
 
 if __name__ == '__main__':